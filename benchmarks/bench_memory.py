@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+# Resident memory of the in-memory index: dict + nested tree vs CompactIndex.
+# Usage: python3 benchmarks/bench_memory.py [entries ...]
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import gitlib
+from synth import synth_paths, write_index
+
+
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_nested(paths):
+    # The dict-of-dicts tree kept next to the dict before PathTrie
+    container = {}
+    for path in paths:
+        node = container
+        parts = path.split("/")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = 1
+    return container
+
+
+def load(kind, filename):
+    if kind == "dict":
+        data = dict((name.decode("utf-8", "replace"), sha.hex()) for name, sha, mode, size in gitlib.parse_fast(filename))
+        files = build_nested(list(data.keys()))
+        return data, files
+    return gitlib.CompactIndex.from_index(filename)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        before = rss()
+        kept = load(sys.argv[2], sys.argv[3])
+        print(rss() - before)
+        sys.exit(0)
+    counts = [int(a) for a in sys.argv[1:]] or [100000, 1000000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            index = os.path.join(tmp, "index")
+            write_index(index, synth_paths(count))
+            for kind in ("dict", "compact"):
+                used = int(subprocess.check_output(
+                    [sys.executable, "-W", "ignore", os.path.abspath(__file__), "--child", kind, index]))
+                print("{0:>9,} entries  {1:<8} {2:>10.1f} MB".format(count, kind, used / 1048576.0))
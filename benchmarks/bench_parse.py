@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+# Compare entries/second of the index parsers on a synthetic index.
+# Usage: python3 benchmarks/bench_parse.py [entries]
+import collections
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gitlib
+from synth import synth_paths, write_index
+
+
+def legacy_parse(filename):
+    # The field-by-field reader parse() used before ENTRY_HEAD
+    with open(filename, "rb") as o:
+        f = mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def read(format):
+            format = "! " + format
+            return struct.unpack(format, f.read(struct.calcsize(format)))[0]
+
+        f.read(4)
+        read("I")
+        count = read("I")
+        for n in range(count):
+            entry = collections.OrderedDict()
+            for key in ("ctime_seconds", "ctime_nanoseconds", "mtime_seconds", "mtime_nanoseconds",
+                        "dev", "ino", "mode", "uid", "gid", "size"):
+                entry[key] = read("I")
+            entry["sha1"] = f.read(20)
+            entry["flags"] = read("H")
+            namelen = entry["flags"] & 0xFFF
+            entry["name"] = f.read(namelen).decode("utf-8", "replace")
+            entrylen = 62 + namelen
+            f.read((8 - (entrylen % 8)) or 8)
+            yield entry
+        f.close()
+
+
+def measure(name, func, filename, count):
+    start = time.perf_counter()
+    for _ in func(filename):
+        pass
+    elapsed = time.perf_counter() - start
+    print("{0:<24} {1:>8.3f}s {2:>12,.0f} entries/s".format(name, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as tmp:
+        index = os.path.join(tmp, "index")
+        size = write_index(index, synth_paths(count))
+        print("{0:,} entries, {1:,} bytes".format(count, size))
+        measure("legacy field-by-field", legacy_parse, index, count)
+        measure("parse(pretty=True)", gitlib.parse, index, count)
+        measure("parse(pretty=False)", lambda f: gitlib.parse(f, False), index, count)
+        measure("parse_fast", gitlib.parse_fast, index, count)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+# Time, peak RSS and requests/second of every phase from index download to get, as JSON.
+# Usage: python3 benchmarks/bench_suite.py [--entries N ...] [--versions 2 3 4] [--shape wide] [--latency ms]
+#                                          [--soft-404] [--failures rate] [--output report.json]
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import gitlib
+from objserver import ObjectServer
+from synth import SHAPES, synth_tree, write_index, write_objects
+
+# queries of the find phase, matching the synth_tree names
+FIND_QUERIES = [["file12"], ["*99.php"], ["*.php", "*.inc"], ["d1/*/file1*"]]
+
+
+def peak_rss():
+    """Peak resident memory since the last reset_peak(), in bytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak():
+    # Linux resets VmHWM to the current RSS; elsewhere the peak is for the whole process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def server_counters(url):
+    with urllib.request.urlopen(url + "/__stats") as response:
+        return json.loads(response.read().decode())
+
+
+def measure(results, name, url, items, func):
+    before = server_counters(url)
+    reset_peak()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    after = server_counters(url)
+    requests = after["requests"] - before["requests"]
+    results.append({
+        "phase": name,
+        "seconds": round(elapsed, 6),
+        "peak_rss_mb": round(peak_rss() / 1048576.0, 1),
+        "items": items,
+        "items_per_second": round(items / elapsed, 1) if elapsed else None,
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 1) if elapsed else None,
+        "failed": after["failed"] - before["failed"],
+        "soft_404": after["soft_404"] - before["soft_404"]
+    })
+
+
+def run_phases(scenario):
+    """Run every phase against the server of scenario; runs in its own process."""
+    url = scenario["url"]
+    entries = scenario["entries"]
+    results = []
+    os.chdir(scenario["workdir"])
+    measure(results, "parse", url, entries, lambda: sum(1 for _ in gitlib.parse_fast(scenario["index"])))
+    manager = []
+    measure(results, "open", url, entries,
+            lambda: manager.append(gitlib.GitManager(url, False, True, threads=scenario["threads"])))
+    manager = manager[0]
+    measure(results, "save_index", url, entries, manager.save_index)
+
+    def load():
+        manager.index_data = None
+        manager.load_index()
+    measure(results, "load_index", url, entries, load)
+
+    def run(commands):
+        for cmd, args in commands:
+            try:
+                manager.exec({"cmd": cmd, "args": args})
+            except ValueError:
+                pass
+    measure(results, "find", url, len(FIND_QUERIES), lambda: run(("find", q) for q in FIND_QUERIES))
+    largest = scenario["largest"]
+    listings = [("ls", []), ("ls", [largest]), ("ls", [largest, "--limit", "100", "--offset", "100"])]
+    measure(results, "ls", url, len(listings), lambda: run(listings))
+    measure(results, "get", url, len(scenario["get"]), lambda: run([("get", scenario["get"])]))
+    return results
+
+
+def largest_dir(paths):
+    counts = {}
+    for path in paths:
+        dirname = path.rpartition("/")[0]
+        counts[dirname] = counts.get(dirname, 0) + 1
+    return max(counts, key=counts.get)
+
+
+def run_scenario(args, tmp, version, entries):
+    site = os.path.join(tmp, "site")
+    git_dir = os.path.join(site, ".git")
+    os.makedirs(git_dir)
+    paths = synth_tree(entries, args.shape)
+    index = os.path.join(git_dir, "index")
+    size = write_index(index, paths, version, blobs=True)
+    rnd = random.Random(args.seed)
+    wanted = rnd.sample(paths, min(args.files, len(paths)))
+    # objects of the missing share are left out, so they end up 404 (or soft 404) pages
+    write_objects(os.path.join(git_dir, "objects"), [p for p in wanted if rnd.random() >= args.missing])
+    workdir = os.path.join(tmp, "work")
+    os.makedirs(workdir)
+    server = ObjectServer(site, 0, args.latency / 1000.0, args.soft_404, args.failures, args.seed).start()
+    try:
+        scenario = {"url": server.url, "index": index, "workdir": workdir, "entries": entries,
+                    "threads": args.threads, "get": wanted, "largest": largest_dir(paths)}
+        scenario_file = os.path.join(tmp, "scenario.json")
+        with open(scenario_file, "w") as f:
+            json.dump(scenario, f)
+        output = subprocess.check_output([sys.executable, "-W", "ignore", os.path.abspath(__file__),
+                                          "--child", scenario_file])
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {"version": version, "entries": entries, "shape": args.shape, "index_bytes": size,
+            "phases": json.loads(output.decode().strip().splitlines()[-1])}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        with open(sys.argv[2]) as f:
+            phases = run_phases(json.load(f))
+        # the last line of the output is the result, commands may print before it
+        sys.stdout.write("\n" + json.dumps(phases) + "\n")
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="Benchmark pwngit phases on synthetic repositories")
+    parser.add_argument("--entries", type=int, nargs="+", default=[10000, 100000],
+                        help="Index sizes, e.g. --entries 10000 2000000")
+    parser.add_argument("--versions", type=int, nargs="+", default=[2, 3, 4], choices=[2, 3, 4])
+    parser.add_argument("--shape", default="default", choices=sorted(SHAPES))
+    parser.add_argument("--files", type=int, default=200, help="Files fetched by the get phase")
+    parser.add_argument("--missing", type=float, default=0, help="Share of fetched files without an object")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds before every response")
+    parser.add_argument("--soft-404", action="store_true", help="Answer missing files with a 200 HTML page")
+    parser.add_argument("--failures", type=float, default=0, help="Share of object requests failing with 503")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": []
+    }
+    for version in args.versions:
+        for entries in args.entries:
+            with tempfile.TemporaryDirectory() as tmp:
+                result = run_scenario(args, tmp, version, entries)
+            report["results"].append(result)
+            print("v{0} {1:>9,} entries: {2}".format(version, entries, ", ".join(
+                "{0} {1:.3f}s".format(p["phase"], p["seconds"]) for p in result["phases"])), file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
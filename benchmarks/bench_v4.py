@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+# Parse time and size of the same tree encoded as index v2 and v4.
+# Usage: python3 benchmarks/bench_v4.py [entries]
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gitlib
+from synth import synth_paths, write_index
+
+
+def timed(func, filename):
+    start = time.perf_counter()
+    for _ in func(filename):
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    paths = synth_paths(count)
+    with tempfile.TemporaryDirectory() as tmp:
+        print("{0:,} entries".format(count))
+        print("{0:<8} {1:>12} {2:>12} {3:>10} {4:>14}".format("version", "bytes", "gzip bytes", "parse_fast", "entries/s"))
+        for version in (2, 4):
+            index = os.path.join(tmp, "index.v{0}".format(version))
+            size = write_index(index, paths, version)
+            with open(index, "rb") as f:
+                wire = len(gzip.compress(f.read()))
+            elapsed = min(timed(gitlib.parse_fast, index) for _ in range(3))
+            print("v{0:<7} {1:>12,} {2:>12,} {3:>9.3f}s {4:>14,.0f}".format(
+                version, size, wire, elapsed, count / elapsed))
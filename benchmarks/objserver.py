@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+# Local stand-in for a web server exposing .git: fixed latency, custom 404 pages and failures.
+# Usage: python3 benchmarks/objserver.py <dir> [port] [--latency ms] [--soft-404] [--failures rate]
+import argparse
+import functools
+import http.server
+import io
+import json
+import random
+import threading
+import time
+
+# the page a "soft 404" server answers missing files with
+SOFT_404_PAGE = b"<html><head><title>Page not found</title></head><body>" + b" " * 4096 + b"</body></html>"
+
+
+class ObjectHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_head(self):
+        server = self.server
+        if self.path == "/__stats":
+            # counters for a benchmark running in another process, not counted itself
+            body = json.dumps(server.counters()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return io.BytesIO(body)
+        with server.lock:
+            server.requests += 1
+            failed = "/objects/" in self.path and server.random.random() < server.failures
+        if server.latency:
+            time.sleep(server.latency)
+        if failed:
+            with server.lock:
+                server.failed += 1
+            self.send_error(503)
+            return None
+        return super().send_head()
+
+    def send_error(self, code, message=None, explain=None):
+        if code == 404 and self.server.soft_404:
+            with self.server.lock:
+                self.server.soft += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(SOFT_404_PAGE)))
+            self.end_headers()
+            self.wfile.write(SOFT_404_PAGE)
+            return
+        return super().send_error(code, message, explain)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ObjectServer(http.server.ThreadingHTTPServer):
+    """Serves directory on 127.0.0.1; port 0 picks a free one.
+
+    Every request waits latency seconds. Requests under /objects/ fail with
+    503 at the failures rate (seeded, so runs repeat), and with soft_404
+    missing files get a 200 HTML page instead of a 404. GET /__stats returns
+    the counters.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, port=0, latency=0.0, soft_404=False, failures=0.0, seed=1):
+        super().__init__(("127.0.0.1", port), functools.partial(ObjectHandler, directory=directory))
+        self.latency = latency
+        self.soft_404 = soft_404
+        self.failures = failures
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+        self.soft = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def counters(self):
+        with self.lock:
+            return {"requests": self.requests, "failed": self.failed, "soft_404": self.soft}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a directory like a web server with an exposed .git")
+    parser.add_argument("directory")
+    parser.add_argument("port", nargs="?", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds before every response")
+    parser.add_argument("--soft-404", action="store_true", help="Answer missing files with a 200 HTML page")
+    parser.add_argument("--failures", type=float, default=0, help="Share of object requests failing with 503")
+    args = parser.parse_args()
+    server = ObjectServer(args.directory, args.port, args.latency / 1000.0, args.soft_404, args.failures)
+    print("Serving {0} on {1}".format(args.directory, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,113 @@
+# _*_ coding:utf-8 _*_
+import hashlib
+import os
+import struct
+import zlib
+
+ENTRY_HEAD = struct.Struct("! 10I 20s H")
+# flags bit of an entry followed by extended flags, allowed from version 3 on
+CE_EXTENDED = 0x4000
+# extended flags written on every EXTENDED_EVERY-th entry of version 3 and 4 indexes, in turn
+EXTENDED_FLAGS = (0x4000, 0x2000)  # skip-worktree, intent-to-add
+EXTENDED_EVERY = 4
+
+
+def synth_paths(count, depth=3, width=20, prefix="src"):
+    """Return `count` sorted repository paths spread over a width**depth tree."""
+    paths = []
+    for n in range(count):
+        dirs = []
+        rest = n
+        for level in range(depth):
+            dirs.append("{0}{1}".format(prefix if level == 0 else "d", rest % width))
+            rest //= width
+        paths.append("/".join(dirs) + "/file{0}.php".format(n))
+    return sorted(paths, key=lambda p: p.encode("utf-8"))
+
+
+# tree shapes for synth_tree: (depth, width, extra characters in every file name)
+SHAPES = {
+    "default": (3, 20, 0),
+    "wide": (1, 2000, 0),
+    "deep": (12, 3, 0),
+    "long": (4, 10, 160),
+}
+
+
+def synth_tree(count, shape="default"):
+    """Return `count` sorted paths of one of the SHAPES."""
+    depth, width, extra = SHAPES[shape]
+    paths = synth_paths(count, depth, width)
+    if extra:
+        paths = sorted((p[:-4] + "_" + "x" * extra + ".php" for p in paths), key=lambda p: p.encode("utf-8"))
+    return paths
+
+
+def blob(path):
+    """Content of the synthetic file at path."""
+    return "<?php // {0}\n".format(path).encode("utf-8") * 8
+
+
+def blob_sha(data):
+    return hashlib.sha1("blob {0}\x00".format(len(data)).encode() + data).digest()
+
+
+def write_objects(objects_dir, paths):
+    """Write the loose objects of the synthetic files at paths."""
+    for path in paths:
+        data = blob(path)
+        hexsha = blob_sha(data).hex()
+        folder = os.path.join(objects_dir, hexsha[:2])
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, hexsha[2:]), "wb") as f:
+            f.write(zlib.compress("blob {0}\x00".format(len(data)).encode() + data))
+
+
+def encode_varint(value):
+    # git's offset varint: big-endian 7-bit groups, each continuation adds one
+    out = [value & 127]
+    value >>= 7
+    while value:
+        value -= 1
+        out.append(128 | (value & 127))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def write_index(filename, paths, version=2, blobs=False):
+    """Write a Git index with one regular-file entry per path.
+
+    With blobs the entries carry the SHA-1 and size of blob(path), so
+    write_objects() can provide their objects. From version 3 on, every
+    EXTENDED_EVERY-th entry has extended flags, so their parsing is measured.
+    """
+    out = bytearray(struct.pack("! 4s I I", b"DIRC", version, len(paths)))
+    previous = b""
+    for n, path in enumerate(paths):
+        name = path.encode("utf-8")
+        if blobs:
+            data = blob(path)
+            sha, size = blob_sha(data), len(data)
+        else:
+            sha, size = hashlib.sha1(b"blob 0\x00" + name).digest(), 0
+        flags = min(len(name), 0xFFF)
+        extended = version >= 3 and n % EXTENDED_EVERY == 0
+        if extended:
+            flags |= CE_EXTENDED
+        out += ENTRY_HEAD.pack(0, 0, 0, 0, 0, 0, 0o100644, 0, 0, size, sha, flags)
+        if extended:
+            out += struct.pack("! H", EXTENDED_FLAGS[n // EXTENDED_EVERY % len(EXTENDED_FLAGS)])
+        if version == 4:
+            common = 0
+            limit = min(len(name), len(previous))
+            while common < limit and name[common] == previous[common]:
+                common += 1
+            out += encode_varint(len(previous) - common) + name[common:] + b"\x00"
+            previous = name
+        else:
+            entrylen = ENTRY_HEAD.size + (2 if extended else 0) + len(name)
+            out += name + b"\x00" * ((8 - (entrylen % 8)) or 8)
+    out += hashlib.sha1(out).digest()
+    with open(filename, "wb") as f:
+        f.write(out)
+    return len(out)
@@ -5,14 +5,30 @@ except ImportError:
     import pyreadline as readline
 import urllib
 import urllib.request
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin, unquote
+import http.client
+import socket
+import ssl
 
 # from gin
+import array
+import base64
 import binascii
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
 import json
 import mmap
+import random
+import re
+import shutil
+import socketserver
 import struct
+import threading
+import time
 import zlib
 import os.path
 import sys
@@ -25,149 +41,1148 @@ def check(boolean, message):
         sys.exit(1)
 
 
-def parse(filename, pretty=True):
+# "All binary numbers are in network byte order."
+# ctime, mtime (seconds, nanoseconds), dev, ino, mode, uid, gid, size,
+# 20-byte sha1 and 16-bit flags: the fixed 62-byte head of every entry
+ENTRY_HEAD = struct.Struct("! 10I 20s H")
+EXTRA_FLAGS = struct.Struct("! H")
+INDEX_HEADER = struct.Struct("! 4s I I")
+EXTENSION_HEADER = struct.Struct("! 4s I")
+# magic, format version, little-endian flag, entries, names size,
+# offset of the first index extension, index checksum
+CACHE_HEADER = struct.Struct("< 4s B B 2x I I I 20s")
+CACHE_MAGIC = b"PGIC"
+CACHE_VERSION = 2
+
+
+def open_mmap(filename):
     with open(filename, "rb") as o:
         if hasattr(mmap, 'PROT_READ'):
-            f = mmap.mmap(o.fileno(), 0, prot=mmap.PROT_READ)
+            return mmap.mmap(o.fileno(), 0, prot=mmap.PROT_READ)
         else:
-            f = mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
+            return mmap.mmap(o.fileno(), 0, access=mmap.ACCESS_READ)
 
-        def read(format):
-            # "All binary numbers are in network byte order."
-            # Hence "!" = network order, big endian
-            format = "! " + format
-            bytes = f.read(struct.calcsize(format))
-            return struct.unpack(format, bytes)[0]
 
-        index = collections.OrderedDict()
+class IndexReader(object):
+    """Decode a Git index straight from the mmap.
 
-        # 4-byte signature, b"DIRC"
-        index["signature"] = f.read(4).decode("ascii")
-        check(index["signature"] == "DIRC", "Not a Git index file")
+    entries() yields plain tuples: the ten ENTRY_HEAD integers, the raw sha1,
+    flags, extended flags (0 if absent) and the name as bytes. Every entry head
+    is decoded by a single precompiled unpack_from, without copying fields out
+    of the map one by one. Version 4 names are rebuilt in place from the
+    previous one.
+    """
 
-        # 4-byte version number
-        index["version"] = read("I")
-        check(index["version"] in {2, 3},
-              "Unsupported version: %s" % index["version"])
+    def __init__(self, filename):
+        self.f = open_mmap(filename)
+        signature, self.version, self.count = INDEX_HEADER.unpack_from(self.f, 0)
+        check(signature == b"DIRC", "Not a Git index file")
+        check(self.version in {2, 3, 4},
+              "Unsupported version: %s" % self.version)
+        self.offset = INDEX_HEADER.size
+
+    def entries(self):
+        if self.version == 4:
+            return self.entries_v4()
+        return self.entries_v2()
+
+    def entries_v2(self):
+        f = self.f
+        version = self.version
+        unpack_head = ENTRY_HEAD.unpack_from
+        unpack_extra = EXTRA_FLAGS.unpack_from
+        head_size = ENTRY_HEAD.size
+        pos = self.offset
+        for n in range(self.count):
+            head = unpack_head(f, pos)
+            flags = head[11]
+            namepos = pos + head_size
+            extra = 0
+            # 1-bit extended, must be 0 in version 2
+            if flags & 0x4000 and version >= 3:
+                extra = unpack_extra(f, namepos)[0]
+                namepos += 2
+            # 12-bit name length, if the length is less than 0xFFF (else, 0xFFF)
+            namelen = flags & 0xFFF
+            if namelen == 0xFFF:
+                # Do it the hard way: the name is NUL-terminated
+                end = f.find(b"\x00", namepos)
+                check(end != -1, "Unterminated entry name")
+                namelen = end - namepos
+            name = f[namepos:namepos + namelen]
+            # 1-8 NUL bytes pad the entry to a multiple of eight
+            entrylen = namepos - pos + namelen
+            pos += entrylen + ((8 - (entrylen % 8)) or 8)
+            yield head + (extra, name)
+        self.offset = pos
+
+    def entries_v4(self):
+        f = self.f
+        view = memoryview(f)
+        unpack_head = ENTRY_HEAD.unpack_from
+        unpack_extra = EXTRA_FLAGS.unpack_from
+        head_size = ENTRY_HEAD.size
+        find = f.find
+        name = bytearray()
+        pos = self.offset
+        try:
+            for n in range(self.count):
+                head = unpack_head(f, pos)
+                pos += head_size
+                extra = 0
+                if head[11] & 0x4000:
+                    extra = unpack_extra(f, pos)[0]
+                    pos += 2
+                # varint: bytes to strip from the end of the previous name
+                c = f[pos]
+                pos += 1
+                strip = c & 127
+                while c & 128:
+                    c = f[pos]
+                    pos += 1
+                    strip = ((strip + 1) << 7) | (c & 127)
+                check(strip <= len(name), "Bad path prefix in entry %d" % (n + 1))
+                # then the NUL-terminated rest of the name, no padding
+                end = find(b"\x00", pos)
+                check(end != -1, "Unterminated entry name")
+                del name[len(name) - strip:]
+                name += view[pos:end]
+                pos = end + 1
+                yield head + (extra, bytes(name))
+        finally:
+            view.release()
+        self.offset = pos
+
+    def extensions(self):
+        f = self.f
+        pos = self.offset
+        end = len(f) - 20
+        while pos < end:
+            signature, size = EXTENSION_HEADER.unpack_from(f, pos)
+            pos += EXTENSION_HEADER.size
+            yield signature.decode("ascii"), pos, size
+            pos += size
+        self.offset = pos
+
+    def checksum(self):
+        return self.f[len(self.f) - 20:]
+
+    def close(self):
+        self.f.close()
+
+
+def index_checksum(filename):
+    """Return the 20-byte trailer checksum of an index without reading the rest."""
+    with open(filename, "rb") as f:
+        f.seek(-20, os.SEEK_END)
+        return f.read(20)
 
-        # 32-bit number of index entries, i.e. 4-byte
-        index["entries"] = read("I")
 
-        yield index
+def parse(filename, pretty=True):
+    reader = IndexReader(filename)
 
-        for n in range(index["entries"]):
-            entry = collections.OrderedDict()
+    index = collections.OrderedDict()
+    index["signature"] = "DIRC"
+    index["version"] = reader.version
+    index["entries"] = reader.count
 
-            entry["entry"] = n + 1
+    yield index
 
-            entry["ctime_seconds"] = read("I")
-            entry["ctime_nanoseconds"] = read("I")
-            if pretty:
-                entry["ctime"] = entry["ctime_seconds"]
-                entry["ctime"] += entry["ctime_nanoseconds"] / 1000000000
-                del entry["ctime_seconds"]
-                del entry["ctime_nanoseconds"]
+    for n, item in enumerate(reader.entries()):
+        entry = collections.OrderedDict()
 
-            entry["mtime_seconds"] = read("I")
-            entry["mtime_nanoseconds"] = read("I")
+        entry["entry"] = n + 1
+
+        if pretty:
+            entry["ctime"] = item[0] + item[1] / 1000000000
+            entry["mtime"] = item[2] + item[3] / 1000000000
+        else:
+            entry["ctime_seconds"] = item[0]
+            entry["ctime_nanoseconds"] = item[1]
+            entry["mtime_seconds"] = item[2]
+            entry["mtime_nanoseconds"] = item[3]
+
+        entry["dev"] = item[4]
+        entry["ino"] = item[5]
+
+        # 4-bit object type, 3-bit unused, 9-bit unix permission
+        entry["mode"] = "%06o" % item[6] if pretty else item[6]
+
+        entry["uid"] = item[7]
+        entry["gid"] = item[8]
+        entry["size"] = item[9]
+
+        entry["sha1"] = binascii.hexlify(item[10]).decode("ascii")
+        entry["flags"] = flags = item[11]
+
+        # 1-bit assume-valid
+        entry["assume-valid"] = bool(flags & (0b10000000 << 8))
+        # 1-bit extended, must be 0 in version 2
+        entry["extended"] = bool(flags & (0b01000000 << 8))
+        # 2-bit stage (?)
+        stage_one = bool(flags & (0b00100000 << 8))
+        stage_two = bool(flags & (0b00010000 << 8))
+        entry["stage"] = stage_one, stage_two
+
+        if entry["extended"] and (reader.version >= 3):
+            entry["extra-flags"] = item[12]
+            # 1-bit reserved
+            entry["reserved"] = bool(item[12] & (0b10000000 << 8))
+            # 1-bit skip-worktree
+            entry["skip-worktree"] = bool(item[12] & (0b01000000 << 8))
+            # 1-bit intent-to-add
+            entry["intent-to-add"] = bool(item[12] & (0b00100000 << 8))
+            # 13-bits unused
+
+        entry["name"] = item[13].decode("utf-8", "replace")
+
+        yield entry
+
+    for extnumber, (signature, offset, size) in enumerate(reader.extensions()):
+        extension = collections.OrderedDict()
+        extension["extension"] = extnumber + 1
+        extension["signature"] = signature
+        extension["size"] = size
+
+        # Seems to exclude the above:
+        # "src_offset += 8; src_offset += extsize;"
+        # Only the cached tree is decoded, unknown extensions are skipped
+        if signature == "TREE":
+            extension["data"] = reader.f[offset:offset + size].decode("iso-8859-1")
             if pretty:
-                entry["mtime"] = entry["mtime_seconds"]
-                entry["mtime"] += entry["mtime_nanoseconds"] / 1000000000
-                del entry["mtime_seconds"]
-                del entry["mtime_nanoseconds"]
+                extension["data"] = json.dumps(extension["data"])
 
-            entry["dev"] = read("I")
-            entry["ino"] = read("I")
+        yield extension
 
-            # 4-bit object type, 3-bit unused, 9-bit unix permission
-            entry["mode"] = read("I")
-            if pretty:
-                entry["mode"] = "%06o" % entry["mode"]
+    checksum = collections.OrderedDict()
+    checksum["checksum"] = True
+    checksum["sha1"] = binascii.hexlify(reader.checksum()).decode("ascii")
+    yield checksum
 
-            entry["uid"] = read("I")
-            entry["gid"] = read("I")
-            entry["size"] = read("I")
+    reader.close()
 
-            entry["sha1"] = binascii.hexlify(f.read(20)).decode("ascii")
-            entry["flags"] = read("H")
 
-            # 1-bit assume-valid
-            entry["assume-valid"] = bool(entry["flags"] & (0b10000000 << 8))
-            # 1-bit extended, must be 0 in version 2
-            entry["extended"] = bool(entry["flags"] & (0b01000000 << 8))
-            # 2-bit stage (?)
-            stage_one = bool(entry["flags"] & (0b00100000 << 8))
-            stage_two = bool(entry["flags"] & (0b00010000 << 8))
-            entry["stage"] = stage_one, stage_two
-            # 12-bit name length, if the length is less than 0xFFF (else, 0xFFF)
-            namelen = entry["flags"] & 0xFFF
-
-            # 62 bytes so far
-            entrylen = 62
-
-            if entry["extended"] and (index["version"] == 3):
-                entry["extra-flags"] = read("H")
-                # 1-bit reserved
-                entry["reserved"] = bool(entry["extra-flags"] & (0b10000000 << 8))
-                # 1-bit skip-worktree
-                entry["skip-worktree"] = bool(entry["extra-flags"] & (0b01000000 << 8))
-                # 1-bit intent-to-add
-                entry["intent-to-add"] = bool(entry["extra-flags"] & (0b00100000 << 8))
-                # 13-bits unused
-                # used = entry["extra-flags"] & (0b11100000 << 8)
-                # check(not used, "Expected unused bits in extra-flags")
-                entrylen += 2
-
-            if namelen < 0xFFF:
-                entry["name"] = f.read(namelen).decode("utf-8", "replace")
-                entrylen += namelen
+def parse_fast(filename):
+    """Yield (name, sha1, mode, size) for every entry, with raw name and sha1 bytes."""
+    reader = IndexReader(filename)
+    try:
+        for item in reader.entries():
+            yield item[13], item[10], item[6], item[9]
+    finally:
+        reader.close()
+
+
+class IndexRecord(object):
+    """Lightweight view of one CompactIndex entry."""
+    __slots__ = ("index", "n")
+
+    def __init__(self, index, n):
+        self.index = index
+        self.n = n
+
+    @property
+    def path(self):
+        return self.index.path(self.n)
+
+    @property
+    def sha1(self):
+        return self.index.hexsha(self.n)
+
+    @property
+    def size(self):
+        return self.index.sizes[self.n]
+
+    @property
+    def mode(self):
+        return self.index.modes[self.n]
+
+    def __repr__(self):
+        return "IndexRecord({0!r}, {1})".format(self.path, self.sha1)
+
+
+class CompactIndex(object):
+    """Index entries packed into flat buffers instead of a dict of strings.
+
+    All names live in one contiguous blob addressed by an offsets array and
+    the SHA-1s are kept raw, 20 bytes each. Entries stay in index order (sorted
+    by name bytes), so path lookups and directory listings are binary searches.
+    It behaves like the old {path: hexsha} mapping for RunCommand.
+
+    save() writes the buffers to a binary cache file and load() maps them back
+    without decoding anything; offsets then point straight into the map.
+    """
+
+    def __init__(self, names, offsets, shas, sizes, modes, checksum=b"", extensions=0):
+        self.names = names
+        self.offsets = offsets
+        self.shas = shas
+        self.sizes = sizes
+        self.modes = modes
+        self.checksum = checksum
+        # where the extensions start in the index file
+        self.extensions = extensions
+        self.tree = None
+        self.trie = None
+
+    @classmethod
+    def from_index(cls, filename):
+        names = bytearray()
+        offsets = array.array("I", [0])
+        shas = bytearray()
+        sizes = array.array("I")
+        modes = array.array("I")
+        reader = IndexReader(filename)
+        try:
+            for item in reader.entries():
+                names += item[13]
+                offsets.append(len(names))
+                shas += item[10]
+                sizes.append(item[9])
+                modes.append(item[6])
+            checksum = reader.checksum()
+        finally:
+            reader.close()
+        return cls(bytes(names), offsets, bytes(shas), sizes, modes, checksum, reader.offset)
+
+    @classmethod
+    def load(cls, filename, checksum=None):
+        """Map a cache written by save(), or return None if it is stale or foreign."""
+        if not os.path.exists(filename):
+            return None
+        f = open_mmap(filename)
+        if len(f) < CACHE_HEADER.size:
+            f.close()
+            return None
+        magic, version, little, count, names_size, extensions, cached = CACHE_HEADER.unpack_from(f, 0)
+        if (magic != CACHE_MAGIC or version != CACHE_VERSION or bool(little) != (sys.byteorder == "little") or
+                (checksum is not None and cached != checksum)):
+            f.close()
+            return None
+        view = memoryview(f)
+        pos = CACHE_HEADER.size
+        offsets = view[pos:pos + (count + 1) * 4].cast("I")
+        pos += (count + 1) * 4
+        sizes = view[pos:pos + count * 4].cast("I")
+        pos += count * 4
+        modes = view[pos:pos + count * 4].cast("I")
+        pos += count * 4
+        shas = view[pos:pos + count * 20]
+        return cls(f, offsets, shas, sizes, modes, cached, extensions)
+
+    def save(self, filename):
+        count = len(self)
+        start = CACHE_HEADER.size + (count + 1) * 4 + count * 28
+        first = self.offsets[0]
+        offsets = array.array("I", (o - first + start for o in self.offsets))
+        tmp = temp_path(filename)
+        with open(tmp, "wb") as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, sys.byteorder == "little", count,
+                                      self.offsets[count] - first, self.extensions, self.checksum))
+            f.write(offsets.tobytes())
+            f.write(self.sizes.tobytes())
+            f.write(self.modes.tobytes())
+            f.write(self.shas[:count * 20])
+            f.write(self.names[first:self.offsets[count]])
+        os.replace(tmp, filename)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def nbytes(self):
+        """Size of the name, SHA-1, offset, size and mode buffers."""
+        count = len(self)
+        return self.offsets[count] - self.offsets[0] + count * 32 + 4
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.path(n)
+
+    def __contains__(self, path):
+        return self.find(path) != -1
+
+    def __getitem__(self, path):
+        n = self.find(path)
+        if n == -1:
+            raise KeyError(path)
+        return self.hexsha(n)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for n in range(len(self)):
+            yield self.path(n), self.hexsha(n)
+
+    def get(self, path, default=None):
+        n = self.find(path)
+        return default if n == -1 else self.hexsha(n)
+
+    def record(self, n):
+        return IndexRecord(self, n)
+
+    def entry(self, path):
+        """IndexRecord of path, looked up once; KeyError if it is not in the index."""
+        n = self.find(path)
+        if n == -1:
+            raise KeyError(path)
+        return IndexRecord(self, n)
+
+    def raw_path(self, n):
+        return self.names[self.offsets[n]:self.offsets[n + 1]]
+
+    def path(self, n):
+        return bytes(self.raw_path(n)).decode("utf-8", "replace")
+
+    def sha(self, n):
+        return bytes(self.shas[n * 20:n * 20 + 20])
+
+    def hexsha(self, n):
+        return binascii.hexlify(self.shas[n * 20:n * 20 + 20]).decode("ascii")
+
+    def bisect(self, key, lo=0, hi=None):
+        # first entry whose name is >= key
+        if hi is None:
+            hi = len(self)
+        names = self.names
+        offsets = self.offsets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if names[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
             else:
-                # Do it the hard way
-                name = []
-                while True:
-                    byte = f.read(1)
-                    if byte == "\x00":
-                        break
-                    name.append(byte)
-                entry["name"] = b"".join(name).decode("utf-8", "replace")
-                entrylen += 1
+                hi = mid
+        return lo
+
+    def find(self, path):
+        key = path.encode("utf-8")
+        n = self.bisect(key)
+        if n < len(self) and self.raw_path(n) == key:
+            return n
+        return -1
+
+    def prefix_range(self, prefix, lo=0, hi=None):
+        """Return (start, stop) of the entries whose name starts with prefix bytes."""
+        start = self.bisect(prefix, lo, hi)
+        if not prefix:
+            return start, len(self) if hi is None else hi
+        stop = self.bisect(prefix[:-1] + bytes([prefix[-1] + 1]), start, hi)
+        return start, stop
+
+    def listdir(self, dirname="", offset=0, limit=None):
+        """Return the children of dirname, subdirectories with a trailing '/'."""
+        return self.path_trie().listdir(dirname, offset, limit) or []
+
+    def directories(self):
+        if self.tree is None:
+            self.tree = DirectoryIndex.build(self)
+        return self.tree
+
+    def path_trie(self):
+        if self.trie is None:
+            self.trie = PathTrie(self)
+        return self.trie
+
+    def match(self, text):
+        """Return the listing entries that complete text, as the shell shows them."""
+        dirname, slash, basename = text.rpartition("/")
+        return [dirname + slash + c for c in self.listdir(dirname) if c.startswith(basename)]
+
+
+class DirNode(object):
+    __slots__ = ("count", "start", "sha", "children")
+
+    def __init__(self, count=-1, sha=None, start=None):
+        # count of index entries below the directory, -1 when unknown
+        self.count = count
+        self.start = start
+        self.sha = sha
+        self.children = {}
+
+
+def parse_tree(buf, offset, size):
+    """Decode a cached-tree (TREE) extension into DirNode objects, root first.
+
+    Every record is "<path>\\0<entries> <subtrees>\\n" followed by the tree
+    SHA-1 unless entries is -1 (invalidated), in pre-order.
+    """
+    pos = offset
+    end = offset + size
+    root = None
+    stack = []
+    while pos < end:
+        nul = buf.find(b"\x00", pos, end)
+        name = buf[pos:nul]
+        newline = buf.find(b"\n", nul, end)
+        count, subtrees = buf[nul + 1:newline].split(b" ")
+        pos = newline + 1
+        node = DirNode(int(count))
+        if node.count >= 0:
+            node.sha = binascii.hexlify(buf[pos:pos + 20]).decode("ascii")
+            pos += 20
+        if stack:
+            stack[-1][0].children[bytes(name)] = node
+            stack[-1][1] -= 1
+        else:
+            root = node
+        if int(subtrees):
+            stack.append([node, int(subtrees)])
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+    return root
+
+
+def read_tree(filename, offset):
+    """Return the root DirNode of the TREE extension, or None without one."""
+    reader = IndexReader(filename)
+    reader.offset = offset
+    try:
+        for signature, start, size in reader.extensions():
+            # other extensions are skipped, not decoded
+            if signature == "TREE":
+                return parse_tree(reader.f, start, size)
+    finally:
+        reader.close()
+    return None
+
+
+class DirectoryIndex(object):
+    """Directories of a CompactIndex with the number of entries under each.
+
+    Seeded from the index TREE extension when present, so masks and diffs
+    jump over whole subdirectories by their entry counts (and SHA-1s) instead
+    of visiting the entries below them. Directories the tree does not know
+    (invalidated or new) fall back to binary searches over the index.
+    """
 
-            padlen = (8 - (entrylen % 8)) or 8
-            nuls = f.read(padlen)
-            check(set(nuls) == {0}, "padding contained non-NUL")
+    def __init__(self, index, root):
+        self.index = index
+        self.root = root
+
+    @classmethod
+    def from_tree(cls, index, filename):
+        root = read_tree(filename, index.extensions) if index.extensions else None
+        return cls(index, root) if root is not None else None
+
+    @classmethod
+    def build(cls, index):
+        # one pass over the sorted names when there is no TREE extension
+        root = DirNode(start=0)
+        stack = [root]
+        previous = []
+        for n in range(len(index)):
+            parts = bytes(index.raw_path(n)).split(b"/")[:-1]
+            common = 0
+            while common < len(parts) and common < len(previous) and parts[common] == previous[common]:
+                common += 1
+            while len(stack) > common + 1:
+                node = stack.pop()
+                node.count = n - node.start
+            for part in parts[common:]:
+                node = DirNode(start=n)
+                stack[-1].children[part] = node
+                stack.append(node)
+            previous = parts
+        for node in stack:
+            node.count = len(index) - node.start
+        return cls(index, root)
+
+    def span(self, node, prefix):
+        if node.start is None:
+            node.start = self.index.bisect(prefix)
+        if node.count < 0:
+            return self.index.prefix_range(prefix, node.start)
+        return node.start, node.start + node.count
+
+
+class TrieNode(object):
+    __slots__ = ("names", "dirs", "count", "size")
+
+    def __init__(self):
+        # listing entries in index order, subdirectories with a trailing '/'
+        self.names = []
+        # subdirectory name (with the '/') -> TrieNode
+        self.dirs = {}
+        # files and their total size below the directory
+        self.count = 0
+        self.size = 0
+
+
+class PathTrie(object):
+    """Directory listings of a CompactIndex, built once and kept sorted.
+
+    Built in one pass over the index: the names come in index order, which is
+    the order ls shows, so children never need sorting. Path segments are
+    interned, a name repeated in many directories is stored once. Every
+    directory knows the number and total size of the files below it, and a
+    page of a listing is a slice of its names.
+    """
 
-            yield entry
+    def __init__(self, index):
+        self.root = root = TrieNode()
+        segments = {}
+        stack = [root]
+        previous = []
+        self.nodes = 1
+        sizes = index.sizes
+        for n in range(len(index)):
+            parts = index.path(n).split("/")
+            name = parts.pop()
+            common = 0
+            while common < len(parts) and common < len(previous) and parts[common] == previous[common]:
+                common += 1
+            while len(stack) > common + 1:
+                done = stack.pop()
+                stack[-1].count += done.count
+                stack[-1].size += done.size
+            for part in parts[common:]:
+                part = part + "/"
+                part = segments.setdefault(part, part)
+                node = TrieNode()
+                stack[-1].names.append(part)
+                stack[-1].dirs[part] = node
+                stack.append(node)
+                self.nodes += 1
+            node = stack[-1]
+            node.names.append(segments.setdefault(name, name))
+            node.count += 1
+            node.size += sizes[n]
+            previous = parts
+        while len(stack) > 1:
+            done = stack.pop()
+            stack[-1].count += done.count
+            stack[-1].size += done.size
+        self.entries = len(index) + self.nodes - 1
+        self.chars = sum(len(part) for part in segments)
+
+    def nbytes(self):
+        """Rough memory estimate: a node with a list and a dict per directory, a pointer per entry."""
+        return self.nodes * 400 + self.entries * 16 + self.chars * 2
+
+    def lookup(self, dirname):
+        node = self.root
+        for part in dirname.strip("/").split("/") if dirname.strip("/") else []:
+            node = node.dirs.get(part + "/")
+            if node is None:
+                return None
+        return node
+
+    def apply(self, old, new, added, removed, changed):
+        """Update the trie from old to new index with the paths of diff_indexes.
+
+        Costs the size of the change, not of the index. Returns False when a
+        path is not found, the trie must then be built again.
+        """
+        for path in removed:
+            n = old.find(path)
+            if n == -1 or not self.__update(path, -1, -old.sizes[n]):
+                return False
+        for path in added:
+            n = new.find(path)
+            if n == -1 or not self.__update(path, 1, new.sizes[n]):
+                return False
+        for path in changed:
+            a, b = old.find(path), new.find(path)
+            if a == -1 or b == -1 or not self.__update(path, 0, new.sizes[b] - old.sizes[a]):
+                return False
+        self.entries = len(new) + self.nodes - 1
+        return True
+
+    def __update(self, path, count, size):
+        # count is 1 to add the file, -1 to remove it, 0 to change its size only
+        parts = path.split("/")
+        name = parts.pop()
+        chain = [self.root]
+        for part in parts:
+            part += "/"
+            node = chain[-1].dirs.get(part)
+            if node is None:
+                if count != 1:
+                    return False
+                node = chain[-1].dirs[part] = TrieNode()
+                bisect.insort(chain[-1].names, part)
+                self.nodes += 1
+                self.chars += len(part)
+            chain.append(node)
+        names = chain[-1].names
+        i = bisect.bisect_left(names, name)
+        present = i < len(names) and names[i] == name
+        if count == 1:
+            if present:
+                return False
+            names.insert(i, name)
+            self.chars += len(name)
+        elif not present:
+            return False
+        elif count == -1:
+            del names[i]
+        for node in chain:
+            node.count += count
+            node.size += size
+        # directories left without files go away with their last one
+        while count == -1 and len(chain) > 1 and not chain[-1].names:
+            chain.pop()
+            part = parts[len(chain) - 1] + "/"
+            del chain[-1].dirs[part]
+            chain[-1].names.remove(part)
+            self.nodes -= 1
+        return True
+
+    def listdir(self, dirname="", offset=0, limit=None):
+        """Return a page of the children of dirname, or None if it is not a directory."""
+        node = self.lookup(dirname)
+        if node is None:
+            return None
+        stop = None if limit is None else offset + limit
+        return node.names[offset:stop]
 
-        indexlen = len(f)
-        extnumber = 1
+    def nested(self, node=None):
+        """The tree as nested dicts, files mapped to 1, as in files.tree."""
+        if node is None:
+            node = self.root
+        return dict((name[:-1], self.nested(node.dirs[name])) if name in node.dirs else (name, 1)
+                    for name in node.names)
 
-        while f.tell() < (indexlen - 20):
-            extension = collections.OrderedDict()
-            extension["extension"] = extnumber
-            extension["signature"] = f.read(4).decode("ascii")
-            extension["size"] = read("I")
 
-            # Seems to exclude the above:
-            # "src_offset += 8; src_offset += extsize;"
-            extension["data"] = f.read(extension["size"])
-            extension["data"] = extension["data"].decode("iso-8859-1")
-            if pretty:
-                extension["data"] = json.dumps(extension["data"])
+def trigrams_of(name):
+    return set(name[i:i + 3] for i in range(len(name) - 2))
 
-            yield extension
-            extnumber += 1
 
-        checksum = collections.OrderedDict()
-        checksum["checksum"] = True
-        checksum["sha1"] = binascii.hexlify(f.read(20)).decode("ascii")
-        yield checksum
+class SearchIndex(object):
+    """Casefolded names of a CompactIndex arranged for find and search.
 
-        f.close()
+    Basenames are kept sorted forwards and reversed, so prefix and suffix
+    queries are binary searches; entries are also grouped by directory and by
+    extension, and a trigram index (built on the first substring query)
+    narrows "contains" queries down to a few candidates. Queries return entry
+    ids, ordered() turns them into paths in index order.
 
+    Ids are the entry numbers of the index the search index was built from;
+    apply() then updates it in place for added and removed paths, appending
+    new ids and leaving removed ones empty.
+    """
 
-def parse_file(arg, pretty=True):
-    data = ""
-    file_hash = {}
+    def __init__(self, index):
+        self.paths = paths = list(index)
+        self.names = []
+        self.by_dir = collections.OrderedDict()
+        self.exts = {}
+        self.dir_names = {}
+        for n, path in enumerate(paths):
+            self.__add(n, path)
+        names = self.names
+        order = sorted(range(len(names)), key=names.__getitem__)
+        self.prefix_keys = [names[n] for n in order]
+        self.prefix_ids = array.array("I", order)
+        order = sorted(range(len(names)), key=lambda n: names[n][::-1])
+        self.suffix_keys = [names[n][::-1] for n in order]
+        self.suffix_ids = array.array("I", order)
+        self.dir_suffix_keys = sorted(d[::-1] for d in self.by_dir)
+        self.trigrams = None
+        self.blob = None
+        self.ids = None
+        # ids stay in index order until apply() appends entries
+        self.in_order = True
+        self.chars = sum(len(p) for p in paths)
+
+    def __add(self, n, path):
+        dirname, slash, name = path.rpartition("/")
+        name = name.casefold()
+        if n == len(self.names):
+            self.names.append(name)
+        else:
+            self.names[n] = name
+        folded = dirname.casefold()
+        if folded not in self.by_dir:
+            self.by_dir[folded] = array.array("I")
+            self.dir_names[folded] = {}
+        self.by_dir[folded].append(n)
+        # every spelling of the directory, with its number of entries
+        spellings = self.dir_names[folded]
+        spellings[dirname] = spellings.get(dirname, 0) + 1
+        dot = name.rfind(".")
+        if dot >= 0:
+            self.exts.setdefault(name[dot:], array.array("I")).append(n)
+        return name, folded
+
+    def nbytes(self):
+        """Rough memory estimate: a path, a name and two sort keys as str objects per entry."""
+        size = len(self.paths) * 240 + self.chars * 2
+        if self.trigrams is not None:
+            size += len(self.trigrams) * 120 + self.chars * 4
+        if self.blob is not None:
+            size += len(self.blob) + len(self.paths) * 4
+        return size
+
+    def apply(self, added, removed):
+        """Remove and add paths in place; the work grows with the number of changes."""
+        if self.ids is None:
+            self.ids = dict((path, n) for n, path in enumerate(self.paths) if path is not None)
+        for path in removed:
+            n = self.ids.pop(path, None)
+            if n is None:
+                continue
+            name = self.names[n]
+            dirname = path.rpartition("/")[0]
+            folded = dirname.casefold()
+            self.by_dir[folded].remove(n)
+            spellings = self.dir_names[folded]
+            spellings[dirname] -= 1
+            if not spellings[dirname]:
+                del spellings[dirname]
+            if not self.by_dir[folded]:
+                del self.by_dir[folded]
+                del self.dir_names[folded]
+                self.__discard(self.dir_suffix_keys, None, folded[::-1], None)
+            dot = name.rfind(".")
+            if dot >= 0:
+                self.exts[name[dot:]].remove(n)
+            self.__discard(self.prefix_keys, self.prefix_ids, name, n)
+            self.__discard(self.suffix_keys, self.suffix_ids, name[::-1], n)
+            if self.trigrams is not None:
+                for gram in trigrams_of(name):
+                    self.trigrams[gram].remove(n)
+            self.paths[n] = self.names[n] = None
+            self.chars -= len(path)
+        for path in added:
+            if path in self.ids:
+                continue
+            n = len(self.paths)
+            self.paths.append(path)
+            self.ids[path] = n
+            self.chars += len(path)
+            new_dir = path.rpartition("/")[0].casefold() not in self.by_dir
+            name, folded = self.__add(n, path)
+            if new_dir:
+                bisect.insort(self.dir_suffix_keys, folded[::-1])
+            self.__insert(self.prefix_keys, self.prefix_ids, name, n)
+            self.__insert(self.suffix_keys, self.suffix_ids, name[::-1], n)
+            if self.trigrams is not None:
+                for gram in trigrams_of(name):
+                    self.trigrams.setdefault(gram, array.array("I")).append(n)
+            self.in_order = False
+        self.blob = None
+
+    def __insert(self, keys, ids, key, n):
+        pos = bisect.bisect_right(keys, key)
+        keys.insert(pos, key)
+        ids.insert(pos, n)
+
+    def __discard(self, keys, ids, key, n):
+        pos = bisect.bisect_left(keys, key)
+        while pos < len(keys) and keys[pos] == key:
+            if ids is None or ids[pos] == n:
+                del keys[pos]
+                if ids is not None:
+                    del ids[pos]
+                return
+            pos += 1
+
+    def ordered(self, ids):
+        """Paths of the ids in index order."""
+        if self.in_order:
+            return [self.paths[n] for n in sorted(ids)]
+        return sorted((self.paths[n] for n in ids), key=lambda p: p.encode("utf-8"))
+
+    def __range(self, keys, ids, prefix):
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix + "\U0010ffff", lo)
+        return ids[lo:hi]
+
+    def in_dir(self, dirname):
+        return list(self.by_dir.get(dirname, []))
+
+    def name_startswith(self, prefix):
+        return self.__range(self.prefix_keys, self.prefix_ids, prefix)
+
+    def name_endswith(self, suffix):
+        if suffix.startswith(".") and suffix.count(".") == 1:
+            # plain extension: answered from the extension map
+            return list(self.exts.get(suffix, []))
+        return self.__range(self.suffix_keys, self.suffix_ids, suffix[::-1])
+
+    def name_contains(self, needle):
+        names = self.names
+        if len(needle) < 3:
+            return [n for n, name in enumerate(names) if name is not None and needle in name]
+        if self.trigrams is None:
+            trigrams = {}
+            for n, name in enumerate(names):
+                if name is None:
+                    continue
+                for gram in trigrams_of(name):
+                    postings = trigrams.get(gram)
+                    if postings is None:
+                        trigrams[gram] = postings = array.array("I")
+                    postings.append(n)
+            self.trigrams = trigrams
+        postings = []
+        for gram in trigrams_of(needle):
+            if not self.trigrams.get(gram):
+                return []
+            postings.append(self.trigrams[gram])
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for other in postings[1:]:
+            candidates.intersection_update(other)
+            if not candidates:
+                return []
+        return [n for n in candidates if needle in names[n]]
+
+    def path_contains(self, needle):
+        # one C-level scan over all casefolded paths joined by newlines
+        if self.blob is None:
+            ids = [n for n, path in enumerate(self.paths) if path is not None]
+            folded = [self.paths[n].casefold() for n in ids]
+            starts = array.array("I")
+            pos = 0
+            for path in folded:
+                starts.append(pos)
+                pos += len(path) + 1
+            self.blob = "\n".join(folded) + "\n"
+            self.starts = starts
+            self.blob_ids = ids
+        result = []
+        blob = self.blob
+        pos = blob.find(needle)
+        while pos != -1:
+            result.append(self.blob_ids[bisect.bisect_right(self.starts, pos) - 1])
+            # continue after the end of this path
+            pos = blob.find(needle, blob.find("\n", pos) + 1)
+        return result
+
+    def dirs_containing(self, needle):
+        return [name for d in self.by_dir if needle in d for name in self.dir_names[d]]
+
+    def dirs_endingwith(self, suffix):
+        keys = self.dir_suffix_keys
+        lo = bisect.bisect_left(keys, suffix[::-1])
+        hi = bisect.bisect_left(keys, suffix[::-1] + "\U0010ffff", lo)
+        return [name for d in keys[lo:hi] for name in self.dir_names[d[::-1]]]
+
+
+search_indexes = collections.OrderedDict()
+# guards search_indexes, used by bot workers and server threads at once
+search_indexes_lock = threading.Lock()
+
+
+def search_index(index, keep=4):
+    """Return the SearchIndex of index, built once per index checksum."""
+    key = index.checksum
+    with search_indexes_lock:
+        if key in search_indexes:
+            search_indexes.move_to_end(key)
+            return search_indexes[key]
+        result = search_indexes[key] = SearchIndex(index)
+        while len(search_indexes) > keep:
+            search_indexes.popitem(last=False)
+        return result
+
+
+def cached_search_index(checksum):
+    """The SearchIndex already built for checksum, or None."""
+    with search_indexes_lock:
+        return search_indexes.get(checksum)
+
+
+def diff_indexes(old, new):
+    """Return (added, removed, changed) paths between two CompactIndexes.
+
+    Both are walked in name order together; a directory whose TREE SHA-1 is
+    the same on both sides is skipped as a whole, so with cached trees the
+    walk touches only the directories that changed.
+    """
+    added, removed, changed = [], [], []
+    old_root = old.tree.root if old.tree is not None else None
+    new_root = new.tree.root if new.tree is not None else None
+
+    def stop_of(index, node, prefix, start, stop):
+        if node is not None and node.count >= 0:
+            return start + node.count
+        return index.prefix_range(prefix, start, stop)[1]
+
+    def walk(i, i_end, j, j_end, old_node, new_node, prefix):
+        while i < i_end or j < j_end:
+            a = old.raw_path(i) if i < i_end else None
+            b = new.raw_path(j) if j < j_end else None
+            if a is not None and b is not None:
+                slash_a = a.find(b"/", len(prefix))
+                slash_b = b.find(b"/", len(prefix))
+                if slash_a != -1 and slash_a == slash_b and a[:slash_a] == b[:slash_b]:
+                    name = bytes(a[len(prefix):slash_a])
+                    old_child = old_node.children.get(name) if old_node is not None else None
+                    new_child = new_node.children.get(name) if new_node is not None else None
+                    child_prefix = bytes(a[:slash_a + 1])
+                    i_stop = stop_of(old, old_child, child_prefix, i, i_end)
+                    j_stop = stop_of(new, new_child, child_prefix, j, j_end)
+                    if (old_child is not None and new_child is not None and old_child.sha is not None and
+                            old_child.count >= 0 and old_child.sha == new_child.sha):
+                        i, j = i_stop, j_stop
+                    else:
+                        walk(i, i_stop, j, j_stop, old_child, new_child, child_prefix)
+                        i, j = i_stop, j_stop
+                    continue
+            if b is None or (a is not None and a < b):
+                removed.append(old.path(i))
+                i += 1
+            elif a is None or b < a:
+                added.append(new.path(j))
+                j += 1
+            else:
+                if old.sha(i) != new.sha(j):
+                    changed.append(new.path(j))
+                i += 1
+                j += 1
+
+    walk(0, len(old), 0, len(new), old_root, new_root, b"")
+    return added, removed, changed
+
+
+GLOB_CHARS = "*?["
+
+
+def has_glob(text):
+    return any(c in text for c in GLOB_CHARS)
+
+
+def translate_glob(pattern):
+    """Translate a file mask into a regular expression.
+
+    '*' and '?' stay inside one path segment, '**' spans directories and
+    '[...]' / '[!...]' are character classes.
+    """
+    i, n = 0, len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                i += 2
+                if pattern.startswith("/", i):
+                    i += 1
+                    out.append("(?:.*/)?")
+                else:
+                    out.append(".*")
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            start = i + 1
+            negate = pattern[start:start + 1] in ("!", "^")
+            if negate:
+                start += 1
+            # a ']' right after '[' or '[!' is part of the class
+            end = pattern.find("]", start + 1)
+            if end == -1:
+                out.append("\\[")
+            else:
+                out.append(translate_class(pattern[start:end], negate))
+                i = end + 1
+                continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def compile_glob(pattern):
+    try:
+        return re.compile(translate_glob(pattern))
+    except re.error:
+        # a mask the translation still gets wrong is matched literally
+        return re.compile(re.escape(pattern))
+
+
+def translate_class(body, negate):
+    # every character escaped, so '[', '^', '\\' and '&&' are plain; a-z stays a range
+    items = []
+    i = 0
+    while i < len(body):
+        if body[i + 1:i + 2] == "-" and i + 2 < len(body):
+            # a reversed range matches nothing, as in fnmatch
+            if body[i] <= body[i + 2]:
+                items.append(re.escape(body[i]) + "-" + re.escape(body[i + 2]))
+            i += 3
+        else:
+            items.append(re.escape(body[i]))
+            i += 1
+    if not items:
+        return "." if negate else "(?!)"
+    return "[" + ("^" if negate else "") + "".join(items) + "]"
+
+
+class GlobMask(object):
+    """A case-insensitive file mask compiled once.
+
+    Masks without '/' match file names anywhere in the tree, like find always
+    did. Masks with '/' match whole paths; their leading directory segments
+    are walked down the DirectoryIndex, so only the matching subtrees are
+    tested against the expression.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern = pattern.casefold().lstrip("/")
+        self.anchored = "/" in pattern
+        self.regex = compile_glob(pattern)
+        self.dirs = []
+        if self.anchored:
+            for part in pattern.split("/")[:-1]:
+                if "**" in part:
+                    break
+                self.dirs.append(compile_glob(part) if has_glob(part) else part)
+
+    def spans(self, tree):
+        nodes = [(tree.root, b"")]
+        walked = []
+        for part in self.dirs:
+            found = []
+            for node, prefix in nodes:
+                if node.count < 0:
+                    # children of an invalidated tree may be incomplete
+                    walked.append((node, prefix))
+                    continue
+                for name, child in node.children.items():
+                    folded = name.decode("utf-8", "replace").casefold()
+                    if folded == part if isinstance(part, str) else part.fullmatch(folded):
+                        found.append((child, prefix + name + b"/"))
+            nodes = found
+        return [tree.span(node, prefix) for node, prefix in walked + nodes]
+
+    def select(self, index, search):
+        """Return the paths matching the mask, in index order."""
+        if self.anchored:
+            fullmatch = self.regex.fullmatch
+            result = []
+            for start, stop in sorted(self.spans(index.directories())):
+                for n in range(start, stop):
+                    path = index.path(n)
+                    if fullmatch(path.casefold()):
+                        result.append(path)
+            return result
+        name = self.pattern
+        if name.startswith("*") and not has_glob(name[1:]):
+            return search.ordered(search.name_endswith(name[1:]))
+        if name.endswith("*") and not has_glob(name[:-1]):
+            return search.ordered(search.name_startswith(name[:-1]))
+        if name.startswith("*") and name.endswith("*") and not has_glob(name[1:-1]):
+            return search.ordered(search.name_contains(name[1:-1]))
+        fullmatch = self.regex.fullmatch
+        return search.ordered(n for n, folded in enumerate(search.names) if folded is not None and fullmatch(folded))
+
+
+def select_masks(masks, index, search):
+    """Paths matching any of the masks, each path once, in index order."""
+    masks = [m if isinstance(m, GlobMask) else GlobMask(m) for m in masks]
+    if len(masks) == 1:
+        return masks[0].select(index, search)
+    result = set()
+    for mask in masks:
+        result.update(mask.select(index, search))
+    return sorted(result, key=lambda p: p.encode("utf-8"))
+
+
+def iter_dump(arg, pretty=True, file_hash=None):
+    """Yield the text dump of an index item by item, never holding all of it."""
     if pretty:
         properties = {
             "version": "[header]",
@@ -176,10 +1191,10 @@ def parse_file(arg, pretty=True):
             "checksum": "[checksum]"
         }
     else:
-        data += "["
+        yield "["
 
     for item in parse(arg, pretty=pretty):
-        c_name = c_hash = ""
+        data = ""
         if pretty:
             for key, value in properties.items():
                 if key in item:
@@ -187,13 +1202,7 @@ def parse_file(arg, pretty=True):
                     break
             else:
                 data += "[?]"
-
-        if pretty:
             for key, value in item.items():
-                if key == "name":
-                    c_name = value
-                if key == "sha1":
-                    c_hash = value
                 data += "\n    " + str(key) + "=" + str(value)
         else:
             data += json.dumps(item)
@@ -204,11 +1213,32 @@ def parse_file(arg, pretty=True):
             else:
                 data += ","
 
-        if c_name and c_hash:
-            file_hash.update({c_name: c_hash})
+        if file_hash is not None and "name" in item and "sha1" in item:
+            file_hash[item["name"]] = item["sha1"]
+        yield data
 
     if not pretty:
-        data += "]"
+        yield "]"
+
+
+def write_dump(arg, out, pretty=True):
+    for chunk in iter_dump(arg, pretty):
+        out.write(chunk)
+
+
+def write_json_map(index, out):
+    # same text as json.dumps({path: sha1}, sort_keys=True, indent=2)
+    paths = sorted(set(index))
+    out.write("{" if paths else "{}")
+    for n, path in enumerate(paths):
+        out.write("," if n else "")
+        out.write("\n  " + json.dumps(path) + ": " + json.dumps(index[path]))
+    out.write("\n}" if paths else "")
+
+
+def parse_file(arg, pretty=True):
+    file_hash = {}
+    data = "".join(iter_dump(arg, pretty, file_hash))
     return data, file_hash
 
 
@@ -218,7 +1248,268 @@ def gin_file(path):
 
 def ensure_dir(f):
     if not os.path.exists(f):
-        os.makedirs(f)
+        os.makedirs(f, exist_ok=True)
+
+
+def temp_path(path):
+    # data/ is shared by threads and processes, each writer gets its own temp file
+    return "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+
+
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+
+def host_slot(url, limit):
+    """Semaphore bounding concurrent requests to the host of url, shared by all managers."""
+    host = urlparse(url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(limit)
+        return host_slots[host]
+
+
+def looks_like_zlib(data):
+    # CMF says deflate and CMF/FLG form a multiple of 31, as every loose object starts
+    return len(data) >= 2 and data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0
+
+
+class SoftNotFound(object):
+    """Pages that hosts send with status 200 instead of 404 for missing files.
+
+    A page is learned by its length and a hash of its first bytes once it has
+    failed the object checks; later responses matching it are dropped after a
+    single small read instead of being downloaded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.dropped = 0
+        self.skipped = 0
+
+    def check(self, url, length, content_type, prefix):
+        """Why the response starting with prefix is not an object, or None."""
+        host = urlparse(url).netloc
+        fingerprint = (length, hashlib.sha1(prefix).digest())
+        with self.lock:
+            known = fingerprint in self.pages.get(host, ())
+        if known:
+            return "known not found page"
+        if content_type in ("text/html", "application/xhtml+xml"):
+            reason = "{0} page".format(content_type)
+        elif not looks_like_zlib(prefix):
+            reason = "not zlib data"
+        else:
+            return None
+        with self.lock:
+            self.pages.setdefault(host, set()).add(fingerprint)
+        return reason
+
+    def drop(self, response, length, read):
+        """Stop a response found to be a not found page, draining it if that is cheaper."""
+        rest = length - read if length is not None else None
+        if rest is not None and rest <= READ_CHUNK:
+            response.release()
+            rest = 0
+        else:
+            response.close()
+        with self.lock:
+            self.dropped += 1
+            self.skipped += rest or 0
+
+    def report(self):
+        with self.lock:
+            return "Soft 404 pages learned: {0}, responses dropped: {1}, bytes not downloaded: {2}".format(
+                sum(len(p) for p in self.pages.values()), self.dropped, self.skipped)
+
+
+# shared by all managers, like the host slots
+soft_not_found = SoftNotFound()
+# bytes read from an object response before deciding whether it is one
+PROBE_SIZE = 512
+
+
+class ObjectStore(object):
+    """Content-addressed objects shared by all repositories under data/.
+
+    Every object is kept once as a loose object and once as its content, both
+    named by SHA-1, so the same vendored file is downloaded a single time for
+    all targets and paths. Repository files are copies of the store, so
+    editing one leaves the stored object intact. Concurrent requests for one
+    SHA-1 are coalesced: the first caller fetches, the others wait for its
+    result.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def object_path(self, sha):
+        return self.root + "/objects/" + sha[:2] + "/" + sha[2:]
+
+    def content_path(self, sha):
+        return self.root + "/contents/" + sha[:2] + "/" + sha[2:]
+
+    def has(self, sha):
+        return os.path.isfile(self.content_path(sha))
+
+    def get(self, sha, fetch):
+        """Make sure sha is stored, calling fetch() once for concurrent callers.
+
+        fetch() adds the object and returns None, or returns the error, which
+        is then handed to every waiting caller as well.
+        """
+        with self.lock:
+            if self.has(sha):
+                self.hits += 1
+                return None
+            flight = self.flights.get(sha)
+            leader = flight is None
+            if leader:
+                flight = self.flights[sha] = [threading.Event(), None]
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.coalesced += 1
+        if not leader:
+            flight[0].wait()
+            return flight[1]
+        try:
+            flight[1] = fetch()
+        finally:
+            with self.lock:
+                del self.flights[sha]
+            flight[0].set()
+        return flight[1]
+
+    def writer(self, sha):
+        return ObjectWriter(self.object_path(sha), self.content_path(sha), sha)
+
+    def add(self, sha, compressed, content):
+        self.__put(self.object_path(sha), compressed)
+        self.__put(self.content_path(sha), content)
+
+    def materialize(self, sha, object_path, file_path):
+        """Copy the stored object and content to the paths of one repository."""
+        self.__copy(self.object_path(sha), object_path)
+        self.__copy(self.content_path(sha), file_path)
+
+    def report(self):
+        total = self.hits + self.misses
+        return "Object store hits: {0}, misses: {1}, coalesced: {2}, hit rate: {3:.1f}%".format(
+            self.hits, self.misses, self.coalesced, 100.0 * self.hits / total if total else 0)
+
+    def __put(self, path, data):
+        ensure_dir(os.path.dirname(path))
+        tmp = temp_path(path)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def __copy(self, source, target):
+        # not a hardlink: editing a downloaded file must not change the object for every repository
+        ensure_dir(os.path.dirname(target))
+        tmp = temp_path(target)
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+
+
+# bytes read from a response at a time
+READ_CHUNK = 64 * 1024
+
+
+class ObjectWriter(object):
+    """Stream a loose object into its object and content files.
+
+    write() takes the compressed bytes as they arrive. The "<type> <size>"
+    header is parsed on the fly and the SHA-1 computed along the way. close()
+    checks both and only then moves the files into place, so memory stays at
+    one chunk whatever the size of the object.
+    """
+
+    def __init__(self, object_path, content_path, sha):
+        self.object_path = object_path
+        self.content_path = content_path
+        self.sha = sha
+        # pid too: object dirs of a repository can be written by several processes
+        self.tmp = ".{0}.{1}.tmp".format(os.getpid(), threading.get_ident())
+        ensure_dir(os.path.dirname(object_path))
+        ensure_dir(os.path.dirname(content_path))
+        self.object_file = open(object_path + self.tmp, "wb")
+        self.content_file = open(content_path + self.tmp, "wb")
+        self.decompressor = zlib.decompressobj()
+        self.check_sum = hashlib.sha1()
+        self.header = b""
+        self.kind = None
+        self.size = None
+        self.written = 0
+        # seconds spent in zlib
+        self.inflate_time = 0.0
+
+    def write(self, chunk):
+        self.object_file.write(chunk)
+        self.__content(self.__inflate(chunk))
+
+    def __inflate(self, chunk):
+        start = time.perf_counter()
+        data = self.decompressor.decompress(chunk) if chunk is not None else self.decompressor.flush()
+        self.inflate_time += time.perf_counter() - start
+        return data
+
+    def __content(self, data):
+        self.check_sum.update(data)
+        if self.size is None:
+            self.header += data
+            end = self.header.find(b"\x00")
+            if end < 0:
+                if len(self.header) > 32:
+                    raise ValueError("Invalid object header")
+                return
+            m = re.match(rb"^(blob|tree|commit|tag) (\d+)$", self.header[:end])
+            if not m:
+                raise ValueError("Invalid object header")
+            self.kind, self.size = m.group(1).decode(), int(m.group(2))
+            data = self.header[end + 1:]
+        self.written += len(data)
+        if self.written > self.size:
+            raise ValueError("Object is larger than its header says")
+        self.content_file.write(data)
+
+    def close(self):
+        """Check the object and move it into place; ValueError if it is not sha."""
+        self.__content(self.__inflate(None))
+        self.object_file.close()
+        self.content_file.close()
+        if not self.decompressor.eof or self.size is None or self.written != self.size:
+            raise ValueError("Object is truncated")
+        if self.check_sum.hexdigest() != self.sha:
+            raise ValueError("Object does not match its SHA-1")
+        os.replace(self.object_path + self.tmp, self.object_path)
+        os.replace(self.content_path + self.tmp, self.content_path)
+
+    def abort(self):
+        self.object_file.close()
+        self.content_file.close()
+        for path in (self.object_path + self.tmp, self.content_path + self.tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+object_stores = {}
+object_stores_lock = threading.Lock()
+
+
+def object_store(root):
+    """ObjectStore of the root folder, shared by all managers."""
+    with object_stores_lock:
+        if root not in object_stores:
+            object_stores[root] = ObjectStore(root)
+        return object_stores[root]
 
 
 def query_yes_no(question, default="yes"):
@@ -254,20 +1545,380 @@ def query_yes_no(question, default="yes"):
                              "(or 'y' or 'n').\n")
 
 
-def set_proxy(proxy_server):
-    proxy = urllib.request.ProxyHandler(
-        {
-            'http': proxy_server,
-            'https': proxy_server,
-        }
-    )
-    opener = urllib.request.build_opener(proxy)
-    urllib.request.install_opener(opener)
+# called as hook(kind, name, value) by every Profiler, kind is "time" or "count"
+profile_hooks = []
+
+
+class Profiler(object):
+    """Phase timings and counters of one GitManager and its commands.
+
+    phase(name) times a block, record() adds a measured duration and count()
+    bumps a counter. Every value also goes to the hooks subscribed to this
+    profiler and to the module-wide profile_hooks, called as
+    hook(kind, name, value).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> [calls, total seconds, longest]
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.hooks = []
+        self.started = time.time()
+
+    def subscribe(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def unsubscribe(self, hook):
+        self.hooks.remove(hook)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+        self.__notify("time", name, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.__notify("count", name, n)
+
+    def __notify(self, kind, name, value):
+        for hook in self.hooks + profile_hooks:
+            hook(kind, name, value)
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "seconds": round(time.time() - self.started, 3),
+                "phases": collections.OrderedDict((name, {"calls": t[0], "seconds": round(t[1], 6),
+                                                          "max": round(t[2], 6)})
+                                                  for name, t in self.timings.items()),
+                "counters": collections.OrderedDict(self.counters)
+            }
+
+    def report(self):
+        with self.lock:
+            lines = ["{0:<22} {1:>6} call(s) {2:>10.3f}s total {3:>9.3f}s max".format(name, t[0], t[1], t[2])
+                     for name, t in self.timings.items()]
+            lines += ["{0:<22} {1:>6}".format(name, n) for name, n in self.counters.items()]
+        return "\n".join(lines) if lines else "Nothing measured yet."
+
+
+class RequestPacer(object):
+    """Spacing of the requests of one HttpSession.
+
+    A token bucket lets burst requests go at once and then one every 1/rate
+    seconds (rate 0 leaves them unpaced), each delayed by up to jitter of the
+    interval so they do not come at a fixed beat. On top of it an adaptive
+    delay doubles on every 429 or 503 answer (Retry-After is honoured) and
+    grows while the latency climbs well over the best seen, then halves
+    again with each quick success. budget caps the requests of the session;
+    once spent, requests fail like unreachable ones.
+    """
+
+    def __init__(self, rate=0.0, burst=1, jitter=0.0, budget=0, retries=2):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.jitter = jitter
+        self.budget = budget
+        # times a 429/503 answer is retried after backing off
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.gate = threading.Lock()
+        self.random = random.Random()
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.delay = 0.0
+        self.pause_until = 0.0
+        self.latency = None
+        self.best = None
+        self.used = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def interval(self):
+        return (1.0 / self.rate if self.rate else 0.0) + self.delay
+
+    def wait(self):
+        """Block until the next request may go; URLError once the budget is spent."""
+        # requests leave one by one, so a grown delay applies to the very next one
+        with self.gate:
+            with self.lock:
+                if self.budget and self.used >= self.budget:
+                    raise urllib.error.URLError("request budget of {0} spent".format(self.budget))
+                self.used += 1
+                now = time.monotonic()
+                interval = self.interval()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) / interval) if interval else self.burst
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    delay = 0.0
+                else:
+                    delay = (1 - self.tokens) * interval
+                    self.tokens = 0.0
+                delay = max(delay, self.pause_until - now) + self.random.uniform(0, self.jitter * interval)
+                self.last = now + delay
+                self.waited += delay
+            if delay > 0:
+                time.sleep(delay)
+
+    def done(self, status, latency, retry_after=None):
+        """Adapt the delay to the answer; return True when the request should be retried."""
+        with self.lock:
+            if status in (429, 503):
+                self.throttled += 1
+                self.delay = min(max(self.delay * 2, 0.1), 10.0)
+                if retry_after is not None and retry_after.isdigit():
+                    self.pause_until = time.monotonic() + min(int(retry_after), 300)
+                return True
+            self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+            self.best = latency if self.best is None else min(self.best, latency)
+            if self.latency > 3 * self.best + 0.05:
+                # the server slows down under our requests
+                self.delay = min(max(self.delay * 1.5, 0.05), 10.0)
+            else:
+                self.delay = self.delay * 0.5 if self.delay > 0.01 else 0.0
+            return False
+
+    def report(self):
+        with self.lock:
+            return ("Paced requests: {0}{1}, throttled answers: {2}, waited: {3:.1f}s, "
+                    "current interval: {4:.3f}s".format(
+                        self.used, " of {0}".format(self.budget) if self.budget else "", self.throttled,
+                        self.waited, self.interval()))
+
+
+class SessionResponse(object):
+    """Response of an HttpSession request.
 
+    read() transparently decodes gzip bodies. The connection goes back to the
+    session pool once the body has been read to the end, or is dropped by
+    close() if it was not.
+    """
+
+    def __init__(self, session, key, conn, response):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        self.finished = False
+        if (response.getheader("Content-Encoding") or "").lower() in ("gzip", "x-gzip"):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decoder = None
 
-def get_url(url, mess="index", exit_on_error=True, raw=False):
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        while True:
+            data = self.response.read() if amt is None else self.response.read(amt)
+            eof = not data or amt is None
+            if data and self.session.profiler is not None:
+                self.session.profiler.count("bytes downloaded", len(data))
+            if self.decoder is not None:
+                data = self.decoder.decompress(data) + (self.decoder.flush() if eof else b"")
+            if eof:
+                self.release()
+            if data or eof:
+                return data
+
+    def release(self):
+        if not self.finished:
+            self.finished = True
+            self.response.read()
+            self.session.release(self.key, self.conn, self.response.will_close)
+
+    def close(self):
+        if not self.finished:
+            # body left unread: the connection cannot be reused
+            self.finished = True
+            self.session.release(self.key, self.conn, True)
+
+
+class HttpSession(object):
+    """Keep-alive HTTP(S) connections reused across index and object requests.
+
+    Connections are pooled per scheme, host and port, the proxy is a setting
+    of the session instead of the process-wide opener, and the counters show
+    how many requests each connection carried. Without proxy_server the
+    http_proxy, https_proxy and no_proxy variables are used, as by urlopen.
+    """
+
+    def __init__(self, proxy_server=None, timeout=15, max_idle=8):
+        if proxy_server:
+            proxies = {"http": proxy_server, "https": proxy_server}
+            self.bypass = None
+        else:
+            proxies = urllib.request.getproxies()
+            self.bypass = urllib.request.proxy_bypass
+        # scheme -> (parsed proxy url, headers for the proxy)
+        self.proxies = {}
+        for scheme in ("http", "https"):
+            if proxies.get(scheme):
+                self.proxies[scheme] = self.__parse_proxy(proxies[scheme])
+        # (scheme, host) -> proxy or None, proxy_bypass may ask the system
+        self.routes = {}
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.context = ssl.create_default_context()
+        self.pool = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.reused = 0
+        # Profiler of the owning manager, gets request latencies and bytes
+        self.profiler = None
+        # RequestPacer spacing the requests, None sends them at once
+        self.pacer = None
+
+    @staticmethod
+    def __parse_proxy(proxy_server):
+        if "://" not in proxy_server:
+            proxy_server = "http://" + proxy_server
+        proxy = urlparse(proxy_server)
+        # user:pass@ of the proxy url, sent to the proxy on every request and tunnel
+        headers = {}
+        if proxy.username is not None:
+            credentials = "{0}:{1}".format(unquote(proxy.username), unquote(proxy.password or ""))
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+        return proxy, headers
+
+    def proxy_for(self, scheme, host):
+        """(parsed proxy url, proxy headers) for requests to host, or None to connect directly."""
+        key = (scheme, host)
+        if key not in self.routes:
+            proxy = self.proxies.get(scheme)
+            if proxy is not None and self.bypass is not None and self.bypass(host):
+                proxy = None
+            self.routes[key] = proxy
+        return self.routes[key]
+
+    def connect(self, scheme, host, port):
+        proxy = self.proxy_for(scheme, host)
+        if proxy:
+            proxy_host, proxy_port = proxy[0].hostname, proxy[0].port or 8080
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=self.timeout,
+                                                   context=self.context)
+                conn.set_tunnel(host, port, proxy[1])
+            else:
+                conn = http.client.HTTPConnection(proxy_host, proxy_port, timeout=self.timeout)
+        elif scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        with self.lock:
+            self.connections += 1
+            if scheme == "https":
+                self.tls_handshakes += 1
+        return conn
+
+    def acquire(self, key):
+        with self.lock:
+            idle = self.pool.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+        return self.connect(*key), False
+
+    def release(self, key, conn, close=False):
+        with self.lock:
+            idle = self.pool.setdefault(key, [])
+            if not close and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def open(self, url, headers=None, redirects=5, retries=None):
+        """GET url; raise urllib.error.HTTPError or URLError like urlopen does."""
+        pacer = self.pacer
+        if pacer is not None:
+            pacer.wait()
+        parsed = urlparse(url)
+        scheme = parsed.scheme
+        key = (scheme, parsed.hostname, parsed.port or (443 if scheme == "https" else 80))
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        proxy = self.proxy_for(scheme, parsed.hostname) if scheme == "http" else None
+        if proxy:
+            path = url
+        request_headers = {"Accept-Encoding": "gzip", "User-Agent": "Python-urllib/%d.%d" % sys.version_info[:2]}
+        if proxy:
+            request_headers.update(proxy[1])
+        request_headers.update(headers or {})
+        for attempt in range(2):
+            conn, reused = self.acquire(key)
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=request_headers)
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if not reused or attempt:
+                    raise urllib.error.URLError(e)
+            except (socket.timeout, OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.requests += 1
+        if self.profiler is not None:
+            # time to the response headers
+            self.profiler.record("http request", latency)
+            if response.status >= 400:
+                self.profiler.count("http errors")
+        result = SessionResponse(self, key, conn, response)
+        if pacer is not None and pacer.done(result.status, latency, result.getheader("Retry-After")):
+            retries = pacer.retries if retries is None else retries
+            if retries:
+                result.release()
+                return self.open(url, headers, redirects, retries - 1)
+        if result.status in (301, 302, 303, 307, 308) and result.getheader("Location") and redirects:
+            result.release()
+            return self.open(urljoin(url, result.getheader("Location")), headers, redirects - 1, retries)
+        if result.status >= 400:
+            result.release()
+            raise urllib.error.HTTPError(url, result.status, result.reason, result.headers, None)
+        return result
+
+    def report(self):
+        per_connection = self.requests / self.connections if self.connections else 0
+        return ("HTTP requests: {0}, connections: {1} ({2} TLS handshakes), "
+                "reused: {3}, requests per connection: {4:.1f}".format(
+                    self.requests, self.connections, self.tls_handshakes, self.reused, per_connection))
+
+
+def get_url(url, mess="index", exit_on_error=True, raw=False, session=None, headers=None):
     try:
-        response = urllib.request.urlopen(url, timeout=15)
+        if session is not None:
+            response = session.open(url, headers)
+        else:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}), timeout=15)
         return {"error": 0, "response": response}
     except urllib.error.HTTPError as e:
         mess = "Error! Cannot get {0} file: {1}".format(mess, e)
@@ -279,7 +1930,7 @@ def get_url(url, mess="index", exit_on_error=True, raw=False):
                 sys.exit(1)
     except urllib.error.URLError as e:
         if raw:
-            return {"error": 1, "response": e}
+            return {"error": 1, "response": "Error! Cannot get {0} file: {1}".format(mess, e.reason)}
         else:
             print(e)
             if exit_on_error:
@@ -287,47 +1938,379 @@ def get_url(url, mess="index", exit_on_error=True, raw=False):
     return False
 
 
+# objects/pack/*.idx: magic and version of the v2 format, 256-entry fanout table
+PACK_IDX_MAGIC = b"\377tOc"
+FANOUT = struct.Struct("! 256I")
+PACK_OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+
+class PackIndex(object):
+    """Object ids and offsets of one pack, read from its mmapped .idx file.
+
+    The fanout table narrows a lookup to the ids sharing their first byte,
+    which are then bisected in place. Both the v1 and the v2 layout are read.
+    """
+
+    def __init__(self, filename):
+        self.f = open_mmap(filename)
+        f = self.f
+        if f[:4] == PACK_IDX_MAGIC:
+            version = struct.unpack_from("! I", f, 4)[0]
+            if version != 2:
+                self.f.close()
+                raise ValueError("Unsupported pack index version {0}".format(version))
+            self.version, table = 2, 8 + FANOUT.size
+        else:
+            self.version, table = 1, FANOUT.size
+        if len(f) < table:
+            self.f.close()
+            raise ValueError("Pack index is truncated")
+        self.fanout = FANOUT.unpack_from(f, table - FANOUT.size)
+        self.count = count = self.fanout[255]
+        if self.version == 2:
+            # ids, crc32s, 31-bit offsets, then 64-bit offsets for big packs
+            self.ids, self.stride = table, 20
+            self.offsets = table + 24 * count
+            self.large = self.offsets + 4 * count
+            valid = len(f) >= self.large + 40
+        else:
+            # (offset, id) pairs
+            self.ids, self.stride = table + 4, 24
+            self.offsets = table
+            valid = len(f) == table + 24 * count + 40
+        if not valid or any(a > b for a, b in zip(self.fanout, self.fanout[1:])):
+            self.f.close()
+            raise ValueError("Not a pack index")
+        self.sorted_offsets = None
+
+    def sha(self, n):
+        pos = self.ids + self.stride * n
+        return self.f[pos:pos + 20]
+
+    def offset(self, n):
+        if self.version == 1:
+            return struct.unpack_from("! I", self.f, self.offsets + 24 * n)[0]
+        offset = struct.unpack_from("! I", self.f, self.offsets + 4 * n)[0]
+        if offset & 0x80000000:
+            offset = struct.unpack_from("! Q", self.f, self.large + 8 * (offset & 0x7fffffff))[0]
+        return offset
+
+    def find(self, sha):
+        """Pack offset of the object with the binary id sha, or None."""
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self.sha(mid)
+            if current < sha:
+                lo = mid + 1
+            elif current > sha:
+                hi = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def end_of(self, offset):
+        """Offset where the object stored at offset ends, None for the last one."""
+        if self.sorted_offsets is None:
+            self.sorted_offsets = sorted(self.offset(n) for n in range(self.count))
+        n = bisect.bisect_right(self.sorted_offsets, offset)
+        return self.sorted_offsets[n] if n < self.count else None
+
+    def close(self):
+        self.f.close()
+
+
+def read_varint(data, pos):
+    # little-endian base-128, as in delta headers
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def read_pack_header(data, pos=0):
+    """Type, inflated size and data position of the pack entry at pos."""
+    byte = data[pos]
+    pos += 1
+    kind, size, shift = (byte >> 4) & 7, byte & 0x0f, 4
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+    return kind, size, pos
+
+
+def read_ofs_delta(data, pos):
+    """Distance back to the base of an OFS_DELTA entry and the data position."""
+    byte = data[pos]
+    pos += 1
+    distance = byte & 0x7f
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        distance = ((distance + 1) << 7) | (byte & 0x7f)
+    return distance, pos
+
+
+def inflate(data, pos, size):
+    out = zlib.decompressobj().decompress(memoryview(data)[pos:], size + 1)
+    if len(out) != size:
+        raise ValueError("Pack entry is truncated")
+    return out
+
+
+def apply_delta(base, delta):
+    src_size, pos = read_varint(delta, 0)
+    dst_size, pos = read_varint(delta, pos)
+    if src_size != len(base):
+        raise ValueError("Delta does not match its base")
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy from base: offset and size bytes present by bit
+            offset = size = 0
+            for bit in range(4):
+                if op & (1 << bit):
+                    offset |= delta[pos] << (8 * bit)
+                    pos += 1
+            for bit in range(3):
+                if op & (0x10 << bit):
+                    size |= delta[pos] << (8 * bit)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            # insert the next op bytes
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise ValueError("Invalid delta opcode")
+    if len(out) != dst_size:
+        raise ValueError("Delta result has a wrong size")
+    return bytes(out)
+
+
+class PackStore(object):
+    """Objects of the packs listed in objects/info/packs, fetched by byte range.
+
+    Only the .idx files are downloaded. An object is read with a Range request
+    covering its own entry of the .pack, delta chains are resolved through an
+    LRU cache of bases. A server ignoring Range sends the whole pack, which is
+    then kept on disk and read locally.
+    """
+
+    def __init__(self, obj_url, obj_dir, session=None, cache_size=32 * 1024 * 1024):
+        self.obj_url = obj_url
+        self.pack_dir = obj_dir + "/pack"
+        self.session = session
+        self.cache_size = cache_size
+        self.packs = None
+        self.local = {}
+        self.lock = threading.Lock()
+        self.bases = collections.OrderedDict()
+        self.cached = 0
+        self.objects = 0
+        self.requests = 0
+        self.received = 0
+        self.hits = 0
+
+    def reset(self):
+        """Forget the pack list, e.g. after the repository was repacked."""
+        with self.lock:
+            self.packs = None
+
+    def load(self):
+        """[(pack name, PackIndex)], fetching objects/info/packs and missing indexes once."""
+        with self.lock:
+            if self.packs is None:
+                packs = []
+                for name in self.list_packs():
+                    idx = self.pack_index(name)
+                    if idx is not None:
+                        packs.append((name, idx))
+                        if name not in self.local and os.path.exists(self.pack_dir + "/" + name + ".pack"):
+                            self.local[name] = open_mmap(self.pack_dir + "/" + name + ".pack")
+                self.packs = packs
+            return self.packs
+
+    def list_packs(self):
+        r = get_url(self.obj_url + "/info/packs", "packs", False, True, self.session)
+        if r["error"] == 1:
+            return []
+        names = []
+        for line in r["response"].read().decode("utf-8", "replace").splitlines():
+            m = re.match(r"^P (pack-[0-9a-f]{40,64})\.pack$", line.strip())
+            if m:
+                names.append(m.group(1))
+        return names
+
+    def pack_index(self, name):
+        filename = self.pack_dir + "/" + name + ".idx"
+        if not os.path.exists(filename):
+            r = get_url(self.obj_url + "/pack/" + name + ".idx", "pack index", False, True, self.session)
+            if r["error"] == 1:
+                return None
+            ensure_dir(self.pack_dir)
+            tmp = temp_path(filename)
+            with open(tmp, "wb") as f:
+                f.write(r["response"].read())
+            os.replace(tmp, filename)
+        try:
+            return PackIndex(filename)
+        except ValueError:
+            os.remove(filename)
+            return None
+
+    def loaded(self):
+        return self.packs is not None
+
+    def locate(self, sha):
+        for name, idx in self.load():
+            offset = idx.find(sha)
+            if offset is not None:
+                return name, idx, offset
+        return None
+
+    def read(self, hexsha):
+        """(type name, content) of a packed object, None if no pack has it."""
+        sha = binascii.unhexlify(hexsha)
+        found = self.locate(sha)
+        if found is None:
+            return None
+        kind, data = self.unpack(*found)
+        kind = PACK_OBJECT_TYPES[kind]
+        check_sum = hashlib.sha1("{0} {1}\x00".format(kind, len(data)).encode())
+        check_sum.update(data)
+        if check_sum.digest() != sha:
+            raise ValueError("Packed object {0} is corrupted".format(hexsha))
+        with self.lock:
+            self.objects += 1
+        return kind, data
+
+    def unpack(self, name, idx, offset):
+        # walk down to a base that is cached or stored whole, then apply the deltas upwards
+        chain = []
+        while True:
+            base = self.cached_base(name, offset)
+            if base is not None:
+                kind, data = base
+                break
+            raw = self.fetch(name, offset, idx.end_of(offset))
+            kind, size, pos = read_pack_header(raw)
+            if kind == OFS_DELTA:
+                distance, pos = read_ofs_delta(raw, pos)
+                chain.append((offset, inflate(raw, pos, size)))
+                offset -= distance
+            elif kind == REF_DELTA:
+                base_offset = idx.find(bytes(raw[pos:pos + 20]))
+                if base_offset is None:
+                    raise ValueError("Delta base is missing from {0}".format(name))
+                chain.append((offset, inflate(raw, pos + 20, size)))
+                offset = base_offset
+            elif kind in PACK_OBJECT_TYPES:
+                data = inflate(raw, pos, size)
+                break
+            else:
+                raise ValueError("Invalid pack entry type {0}".format(kind))
+        for delta_offset, delta in reversed(chain):
+            self.remember(name, offset, kind, data)
+            data = apply_delta(data, delta)
+            offset = delta_offset
+        return kind, data
+
+    def cached_base(self, name, offset):
+        with self.lock:
+            base = self.bases.get((name, offset))
+            if base is not None:
+                self.bases.move_to_end((name, offset))
+                self.hits += 1
+            return base
+
+    def remember(self, name, offset, kind, data):
+        with self.lock:
+            if (name, offset) in self.bases or len(data) > self.cache_size:
+                return
+            self.bases[(name, offset)] = (kind, data)
+            self.cached += len(data)
+            while self.cached > self.cache_size:
+                self.cached -= len(self.bases.popitem(last=False)[1][1])
+
+    def fetch(self, name, start, end):
+        """Raw bytes of the pack entry at [start, end); end None reads to the trailer."""
+        if name in self.local:
+            f = self.local[name]
+            return f[start:end if end is not None else len(f) - 20]
+        url = self.obj_url + "/pack/" + name + ".pack"
+        headers = {"Range": "bytes={0}-{1}".format(start, end - 1 if end is not None else ""),
+                   "Accept-Encoding": "identity"}
+        r = get_url(url, "pack", False, True, self.session, headers)
+        if r["error"] == 1:
+            raise ValueError(r["response"])
+        resp = r["response"]
+        if resp.status == 206:
+            data = resp.read()
+            with self.lock:
+                self.requests += 1
+                self.received += len(data)
+            return data
+        # the server ignored Range: keep the whole pack and read it locally
+        with self.lock:
+            if name not in self.local:
+                filename = self.pack_dir + "/" + name + ".pack"
+                ensure_dir(self.pack_dir)
+                size = 0
+                tmp = temp_path(filename)
+                with open(tmp, "wb") as f:
+                    for chunk in iter(lambda: resp.read(READ_CHUNK), b""):
+                        f.write(chunk)
+                        size += len(chunk)
+                os.replace(tmp, filename)
+                self.requests += 1
+                self.received += size
+                self.local[name] = open_mmap(filename)
+            else:
+                resp.close()
+        return self.fetch(name, start, end)
+
+    def report(self):
+        return ("Packs: {0}, objects read from packs: {1}, pack requests: {2}, "
+                "bytes received: {3}, delta base cache hits: {4}".format(
+                    len(self.packs or []), self.objects, self.requests, self.received, self.hits))
+
+
+# words completed as the first word of a line
+COMMANDS = ["diff", "dump", "exit", "find", "get", "help", "ls", "quit", "refresh", "search", "stats", "watch"]
+
+
 # This class enable list autocompletion
 class ListCompleter(object):  # Custom completer
+    """Tab completion for commands, paths of get and ls, and file names of find.
+
+    Candidates come from sorted lists by binary search: the listings of the
+    PathTrie and the name keys of the SearchIndex. While the same word grows,
+    the previous candidates are searched again instead of the whole directory.
+    """
 
     def __init__(self, options):
         self.options = options
+        self.matches = []
+        # (index, context, prefix, keys, values) of the previous completion
+        self.last = None
 
     def complete(self, text, state):
-        result = []
         if state == 0:  # on first trigger, build possible matches
-            if text:  # cache matches (entries that start with entered text)
-                current_options = self.options
-                current_path = os.path.dirname(text)
-                path = text.split("/")
-                if len(path) > 1:
-                    path = current_path.split("/")
-                    current_path += "/"
-                    text = os.path.basename(text)
-                    for p in path:
-                        if type(current_options) is dict:
-                            if p in current_options:
-                                current_options = current_options[p]
-                            else:
-                                return None
-                        else:
-                            break
-                if type(current_options) is dict:
-                    for k, v in current_options.items():
-                        value = ""
-                        if type(v) is dict:
-                            value = k + "/"
-                        elif type(k) is str:
-                            value = k
-                        if value and value.startswith(text):
-                            result.append(current_path + value)
-            else:  # no text entered, all matches possible
-                for k, v in self.options.items():
-                    if type(v) is dict:
-                        result.append(k + "/")
-                    elif type(k) is str:
-                        result.append(k)
-            self.matches = sorted(result)
+            self.matches = self.candidates(readline.get_line_buffer()[:readline.get_begidx()], text)
 
         # return match indexed by state
         try:
@@ -335,13 +2318,55 @@ class ListCompleter(object):  # Custom completer
         except IndexError:
             return None
 
+    def candidates(self, line, text):
+        """Completions of text, the word after line."""
+        words = line.split()
+        if not words:
+            return self.narrow("command", text, lambda: (COMMANDS, COMMANDS))[1]
+        command = words[0]
+        if command in ("get", "ls") or (command == "find" and "/" in text):
+            dirname, slash, basename = text.rpartition("/")
+            node = self.options.path_trie().lookup(dirname)
+            if node is None:
+                return []
+            names = self.narrow(dirname + slash, basename, lambda: (node.names, node.names))[1]
+            return [dirname + slash + n for n in names if command != "ls" or n.endswith("/")]
+        if command == "find" and not has_glob(text):
+            search = search_index(self.options)
+            ids = self.narrow("find", text.casefold(), lambda: (search.prefix_keys, search.prefix_ids))[1]
+            return sorted(set(search.paths[n].rpartition("/")[2] for n in ids))
+        return []
+
+    def narrow(self, context, prefix, source):
+        """Return (keys, values) of the sorted candidates whose key starts with prefix."""
+        last = self.last
+        if last is not None and last[0] is self.options and last[1] == context and prefix.startswith(last[2]):
+            keys, values = last[3], last[4]
+        else:
+            keys, values = source()
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix + "\U0010ffff", lo)
+        keys, values = keys[lo:hi], values[lo:hi]
+        self.last = (self.options, context, prefix, keys, values)
+        return keys, values
+
+
+# longest watch, in seconds, for commands run by -c, batches, the server and the bot
+WATCH_LIMIT = 600
+
 
 class RunCommand(object):
-    def __init__(self, data, files, opts, raw_cmd=False):
+    def __init__(self, data, opts, raw_cmd=False):
         self.raw_cmd = True if raw_cmd else False
         self.data = data
-        self.files = files
         self.options = opts
+        # called as progress(done, total, path) while several files are fetched
+        self.progress = None
+        # threading.Event stopping a multi-file get once set
+        self.cancel = None
+        # GitManager owning the index, for refresh and watch
+        self.manager = None
+        self.profiler = opts.get("profiler") or Profiler()
 
     def ret(self, message):
         if self.raw_cmd:
@@ -363,7 +2388,11 @@ class RunCommand(object):
     def find(self, arg):
         needle = " ".join(arg)
         if len(needle) >= 3:
-            out = self.__find(needle, True)
+            if len(arg) > 1 and all(has_glob(a) for a in arg):
+                # several masks: find *.php *.inc
+                out = self.__find_all(arg)
+            else:
+                out = self.__find(needle, True)
             if out:
                 return self.ret("\n".join(out))
             else:
@@ -372,52 +2401,196 @@ class RunCommand(object):
             return self.ret("Search query must be greater than 3 characters.")
 
     def ls(self, arg):
-        if arg:
-            return self.ret(self.__dir("".join(arg)))
-        else:
-            return self.ret(self.__dir())
+        words = []
+        page = {"--offset": 0, "--limit": None}
+        arg = list(arg)
+        while arg:
+            word = arg.pop(0)
+            if word in page:
+                if not arg or not arg[0].isdigit():
+                    return self.ret("Usage: ls [dir] [--limit N] [--offset N]")
+                page[word] = int(arg.pop(0))
+            else:
+                words.append(word)
+        if self.data.trie is None:
+            with self.profiler.phase("path trie build"):
+                self.data.path_trie()
+        if page["--limit"] is None and not page["--offset"]:
+            return self.ret(self.__dir("".join(words)))
+        return self.ret(self.__page("".join(words), page["--offset"], page["--limit"]))
 
     def help(self, arg):
         print("Commands:\n"
               "help                 show this info\n"
-              "ls [dir]             list files in repository path\n"
-              "get <path|mask>      get, save and show file by path or mask. Ex.: get *.ini\n"
-              "find <query>         find files by name or path. Ex.: find *.sql\n"
+              "ls [dir] [page]      list files in repository path, page: --limit N --offset N\n"
+              "get <path|mask> ...  get, save and show files by paths or masks. Ex.: get config/**/*.php *.ini\n"
+              "find <query|masks>   find files by name, path or masks (*, ?, [...], **). Ex.: find *.sql *.bak\n"
               "search <query>       find folders by name or path. Ex.: search wp-content\n"
+              "dump [json] [file]   write parsed index to file or stdout. Ex.: dump json index.json\n"
+              "stats [json|reset]   show timings, HTTP, pack, object store and soft 404 statistics\n"
+              "refresh              reload index only if it changed on the server\n"
+              "watch [sec] [times]  refresh every sec seconds (default 60) until Ctrl+C\n"
+              "diff                 show files changed by the last index update\n"
               "exit|quit|e|q        exit to select repository mode\n")
 
+    def refresh(self, arg):
+        if self.manager is None:
+            return self.ret("Nothing to refresh.")
+        if self.manager.refresh():
+            self.data = self.manager.index_data
+        return self.ret("") if self.raw_cmd else None
+
+    def watch(self, arg):
+        try:
+            interval = float(arg[0]) if arg else 60
+            times = int(arg[1]) if len(arg) > 1 else 0
+        except ValueError:
+            return self.ret("Usage: watch [sec] [times]")
+        if interval <= 0 or times < 0:
+            return self.ret("Usage: watch [sec] [times]")
+        if self.raw_cmd:
+            # remote callers hold the repository lock: never watch without an end
+            if interval * max(times, 1) > WATCH_LIMIT:
+                return self.ret("Watch is limited to {0} seconds here.".format(WATCH_LIMIT))
+            times = times or int(WATCH_LIMIT // interval) or 1
+        checks = 0
+        try:
+            while times == 0 or checks < times:
+                checks += 1
+                self.refresh([])
+                if self.progress is not None:
+                    self.progress(checks, times, "")
+                if times == 0 or checks < times:
+                    if self.cancel is None:
+                        time.sleep(interval)
+                    elif self.cancel.wait(interval):
+                        break
+        except KeyboardInterrupt:
+            pass
+        return self.ret("Index checked {0} time(s).".format(checks))
+
+    def diff(self, arg):
+        diff_file = self.options["index_file"] + ".diff"
+        if not os.path.exists(diff_file):
+            return self.ret("No index changes recorded yet.")
+        with open(diff_file, encoding="utf-8") as df:
+            changes = json.load(df)
+        lines = ["Index changes at {0}:".format(changes["time"])]
+        lines += ["+ " + p for p in changes["added"]]
+        lines += ["- " + p for p in changes["removed"]]
+        lines += ["~ " + p for p in changes["changed"]]
+        return self.ret("\n".join(lines))
+
+    def stats(self, arg):
+        if arg and arg[0] == "reset":
+            self.profiler.reset()
+            return self.ret("Timings and counters cleared.")
+        if arg and arg[0] == "json":
+            profile = self.manager.profile() if self.manager is not None else self.profiler.as_dict()
+            return self.ret(json.dumps(profile, indent=2))
+        session = self.options.get("session")
+        lines = [self.profiler.report()]
+        lines.append(session.report() if session is not None else "No HTTP session.")
+        if session is not None and session.pacer is not None:
+            lines.append(session.pacer.report())
+        packs = self.options.get("packs")
+        if packs is not None and packs.loaded():
+            lines.append(packs.report())
+        store = self.options.get("store")
+        if store is not None:
+            lines.append(store.report())
+        lines.append(soft_not_found.report())
+        return self.ret("\n".join(lines))
+
+    def dump(self, arg):
+        pretty = not (arg and arg[0] == "json")
+        if not pretty:
+            arg = arg[1:]
+        if arg and arg[0] != "-":
+            filename = arg[0]
+            if self.raw_cmd:
+                # commands may come from the server or the bot: files stay in the repository folder
+                root = os.path.realpath(self.options["dir_name"])
+                filename = os.path.realpath(os.path.join(root, filename))
+                if not filename.startswith(root + os.sep):
+                    return self.ret("Dump file must be inside '{0}'.".format(self.options["dir_name"]))
+            try:
+                with open(filename, "w", encoding="utf-8") as out:
+                    write_dump(self.options["index_file"], out, pretty)
+                    out.close()
+            except (IOError, OSError) as e:
+                return self.ret("Cannot save index dump to '{0}': {1}".format(filename, e.strerror or e))
+            return self.ret("Index dump saved to '{0}'.".format(filename))
+        if self.raw_cmd:
+            out = io.StringIO()
+            write_dump(self.options["index_file"], out, pretty)
+            return self.ret(out.getvalue())
+        write_dump(self.options["index_file"], sys.stdout, pretty)
+        return self.ret("")
+
     def get(self, arg):
         files_data = ""
-        for a in arg:
-            files = self.__find(a, True, True)
-            if files:
-                answer = True
-                show = True
-                files_count = len(files)
+        files = self.__find_all(arg)
+        if files:
+            answer = True
+            show = True
+            files_count = len(files)
+            if files_count > 1:
+                show = False
+            if files_count > 10 and not self.raw_cmd:
+                answer = query_yes_no("Are you sure to load {0} files from repository?".format(len(files)))
+            if answer is True:
                 if files_count > 1:
-                    show = False
-                if files_count > 10:
-                    answer = query_yes_no("Are you sure to load {0} files from repository?".format(len(files)))
-                if answer is True:
-                    for file in files:
-                        if self.raw_cmd:
-                            files_data += self.__get(file, show)
-                        else:
-                            self.__get(file, show)
-                    if self.raw_cmd:
-                        return files_data
-            else:
-                return self.ret("Cannot find any file(s)".format(files))
+                    files_data = "".join(self.__get_many(files))
+                else:
+                    files_data = self.__get(files[0], show)
+                if self.raw_cmd:
+                    return files_data
+        else:
+            return self.ret("Cannot find any file(s)".format(files))
+
+    def __get_many(self, files):
+        # same per-file results as __get, fetched by a pool of threads
+        total = len(files)
+        results = [""] * total
+        done = 0
+        threads = self.options.get("threads", 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = dict((pool.submit(self.__get, f, False), n) for n, f in enumerate(files))
+            for future in concurrent.futures.as_completed(futures):
+                n = futures[future]
+                try:
+                    results[n] = future.result() or ""
+                except (IOError, OSError, http.client.HTTPException) as e:
+                    # a truncated response fails its own file, not the whole get
+                    results[n] = self.ret("Cannot get '{0}' file: {1}".format(files[n], e)) or ""
+                done += 1
+                if self.progress is not None:
+                    self.progress(done, total, files[n])
+                elif not self.raw_cmd:
+                    print("[{0}/{1}] {2}".format(done, total, files[n]))
+                if self.cancel is not None and self.cancel.is_set() and done < total:
+                    # files already being fetched finish, the others are dropped
+                    for pending in futures:
+                        pending.cancel()
+                    results.append(self.ret("Cancelled after {0} of {1} file(s).".format(done, total)) or "")
+                    break
+        return results
 
     def __get(self, a, show):
-        folder = self.data[a][0:2]
-        file = self.data[a][2:]
+        # the path is looked up once, the download steps share its record
+        entry = self.data.entry(a)
+        folder = entry.sha1[0:2]
+        file = entry.sha1[2:]
         object_file_path = self.options["git_obj_dir"] + "/" + folder + "/" + file
         file_path = self.options["dir_name"] + "/" + a
-        url_path = self.options["git_obj_url"] + "/" + folder + "/" + file
         if os.path.isfile(file_path) is True:
+            self.profiler.count("files already saved")
             if self.raw_cmd is True or (show is True and query_yes_no("File '{}' already exists. View?".format(a))):
                 return self.ret(self.__show(file_path))
+            if show is True:
+                return
+        store = self.options["store"]
         if os.path.isfile(object_file_path) is True:
             if self.raw_cmd or (show is True and query_yes_no("Object file already exists. Unpack?")):
                 with open(object_file_path, "rb") as ofile:
@@ -433,117 +2606,171 @@ class RunCommand(object):
                     ofile.close()
                 return self.ret(self.__show(file_path))
         else:
-            ensure_dir(self.options["git_obj_dir"] + "/" + folder)
-            print("Downloading '{0}' file ...".format(a))
-            resp = self.__download(url_path)
-            if resp is False:
-                return resp
-            if resp["error"] is 1:
-                return self.ret(resp["response"])
+            sha = entry.sha1
+            stored = store.has(sha)
+            self.profiler.count("object store hits" if stored else "object store misses")
+            error = store.get(sha, lambda: self.__fetch(entry))
+            if error is False:
+                return error
+            if error is not None:
+                return self.ret(error)
+            store.materialize(sha, object_file_path, file_path)
+            if show is True:
+                return self.ret(self.__show(file_path))
+            elif stored:
+                return self.ret("File '{0}' copied from object store.".format(a))
             else:
-                resp = resp["response"]
-                data = resp.read()
-                try:
-                    deflate_data = self.__deflate(data)
-                except zlib.error as e:
-                    return self.ret(
-                        "Cannot decompress '{}' file\r\n"
-                        "{}\r\n"
-                        "Maybe server have custom 404 error.\r\n".format(a, e)
-                    )
-                self.__write(object_file_path, data)
-                self.__write(file_path, deflate_data[deflate_data.find(b'\x00')+1:])
-                if show is True:
-                    return self.ret(self.__show(file_path))
-                else:
-                    return self.ret("File '{0}' downloaded successfully.".format(a))
+                return self.ret("File '{0}' downloaded successfully.".format(a))
+
+    def __fetch(self, entry):
+        # download the object of entry into the shared store: None on success, else the error
+        a = entry.path
+        folder = entry.sha1[0:2]
+        file = entry.sha1[2:]
+        url_path = self.options["git_obj_url"] + "/" + folder + "/" + file
+        packs = self.options.get("packs")
+        # once the packs are known the loose object request is skipped for packed objects
+        packs_tried = packs is not None and packs.loaded()
+        if packs_tried:
+            packed = self.__fetch_packed(entry)
+            if packed is not False:
+                return None if packed is True else packed
+        print("Downloading '{0}' file ...".format(a))
+        soft = None
+        with host_slot(url_path, self.options.get("threads", 4)):
+            resp = self.__download(url_path)
+            if resp["error"] != 1:
+                soft, prefix = self.__probe(a, url_path, resp["response"])
+                if soft is None:
+                    error = self.__stream(entry, resp["response"], prefix)
+        if resp["error"] == 1 or soft is not None:
+            # a custom 404 page is a missing loose object too
+            if packs is not None and not packs_tried:
+                packed = self.__fetch_packed(entry)
+                if packed is not False:
+                    return None if packed is True else packed
+            return resp["response"] if soft is None else soft
+        return error
+
+    def __probe(self, a, url, response):
+        # look at the headers and first bytes before downloading the rest
+        length = response.getheader("Content-Length")
+        length = int(length) if length and length.isdigit() else None
+        content_type = (response.getheader("Content-Type") or "").split(";")[0].strip().lower()
+        try:
+            prefix = response.read(PROBE_SIZE)
+        except (IOError, OSError, http.client.HTTPException) as e:
+            response.close()
+            return "Cannot get '{0}' file: {1}".format(a, e), b""
+        reason = soft_not_found.check(url, length, content_type, prefix)
+        if reason is None:
+            return None, prefix
+        self.profiler.count("soft 404 dropped")
+        soft_not_found.drop(response, length, len(prefix))
+        return "Cannot get '{0}' file: server answered with a custom 404 page ({1})".format(a, reason), prefix
+
+    def __stream(self, entry, response, prefix=b""):
+        # the object goes to the store chunk by chunk, never whole in memory
+        a = entry.path
+        writer = self.options["store"].writer(entry.sha1)
+        try:
+            writer.write(prefix)
+            for chunk in iter(lambda: response.read(READ_CHUNK), b""):
+                writer.write(chunk)
+            writer.close()
+            self.profiler.count("objects downloaded")
+        except zlib.error as e:
+            writer.abort()
+            response.close()
+            return ("Cannot decompress '{}' file\r\n"
+                    "{}\r\n"
+                    "Maybe server have custom 404 error.\r\n".format(a, e))
+        except (ValueError, IOError, OSError, http.client.HTTPException) as e:
+            writer.abort()
+            response.close()
+            return "Cannot get '{0}' file: {1}".format(a, e)
+        finally:
+            self.profiler.record("decompress", writer.inflate_time)
+        return None
+
+    def __fetch_packed(self, entry):
+        # True once stored, False when no pack has the object, else the error
+        a, sha = entry.path, entry.sha1
+        url_path = self.options["git_obj_url"] + "/pack"
+        try:
+            with host_slot(url_path, self.options.get("threads", 4)), self.profiler.phase("pack read"):
+                packed = self.options["packs"].read(sha)
+        except (ValueError, zlib.error, IOError, OSError, http.client.HTTPException) as e:
+            return "Cannot get '{0}' file from pack: {1}".format(a, e)
+        if packed is None:
+            return False
+        kind, data = packed
+        self.options["store"].add(sha, zlib.compress("{0} {1}\x00".format(kind, len(data)).encode() + data), data)
+        return True
+
+    def __search_index(self):
+        if cached_search_index(self.data.checksum) is not None:
+            self.profiler.count("search index hits")
+            return search_index(self.data)
+        with self.profiler.phase("search index build"):
+            return search_index(self.data)
 
     def __find(self, needle, in_files=False, for_get=False):
-        haystack = self.data.keys()
+        index = self.__search_index()
         needle = needle.casefold()
-        dirname = os.path.dirname(needle).casefold()
-        filename = os.path.basename(needle).casefold()
         if in_files:
-            if filename.startswith("*") and filename.endswith("*"):
-                filename = filename[1:][:-1]
-                if dirname:
-                    out = [s for s in haystack if os.path.dirname(s.casefold()) == dirname]
-                    if out and filename:
-                        out = [s for s in out if filename in os.path.basename(s.casefold())]
-                else:
-                    out = [s for s in haystack if filename in os.path.basename(s.casefold())]
-            elif filename.startswith("*"):
-                if dirname:
-                    out = [s for s in haystack if os.path.dirname(s.casefold()) == dirname]
-                    if out and filename:
-                        out = [s for s in out if os.path.basename(s.casefold()).endswith(filename[1:])]
-                else:
-                    out = [s for s in haystack if os.path.basename(s.casefold()).endswith(needle[1:])]
-            elif filename.endswith("*"):
-                if dirname:
-                    out = [s for s in haystack if os.path.dirname(s.casefold()) == dirname]
-                    if out and filename:
-                        out = [s for s in out if os.path.basename(s.casefold()).startswith(filename[:-1])]
-                else:
-                    out = [s for s in haystack if os.path.basename(s.casefold()).startswith(needle[:-1])]
+            if has_glob(needle):
+                out = select_masks([needle], self.data, index)
+            elif os.path.dirname(needle):
+                out = index.ordered(index.path_contains(needle))
             else:
-                if dirname:
-                    out = [s for s in haystack if needle in s.casefold()]
-                else:
-                    out = [s for s in haystack if needle in os.path.basename(s.casefold())]
+                out = index.ordered(index.name_contains(needle))
             if out:
                 self.ret("Found {0} file(s) ...".format(len(out)))
         else:
             if needle.endswith("*"):
-                out = list(set(
-                    [os.path.dirname(s) for s in haystack if needle[:-1] in os.path.dirname(s.casefold())]
-                ))
+                out = index.dirs_containing(needle[:-1])
             else:
-                out = list(set(
-                    [os.path.dirname(s) for s in haystack if os.path.dirname(s.casefold()).endswith(needle)]
-                ))
+                out = index.dirs_endingwith(needle)
             if out:
                 self.ret("Found {0} item(s) ...".format(len(out)))
 
         return out
 
+    def __find_all(self, args):
+        # masks are compiled together, plain names keep their substring search
+        index = self.__search_index()
+        masks = [a for a in args if has_glob(a)]
+        out = select_masks(masks, self.data, index) if masks else []
+        seen = set(out)
+        for a in args:
+            if not has_glob(a):
+                for path in self.__find(a, True, True):
+                    if path not in seen:
+                        seen.add(path)
+                        out.append(path)
+        if masks and out:
+            self.ret("Found {0} file(s) ...".format(len(out)))
+        return out
+
     def __dir(self, text=""):
-        result = []
-        if text:  # cache matches (entries that start with entered text)
-            current_options = self.files
-            current_path = os.path.dirname(text)
-            path = text.split("/")
-            if len(path) > 1:
-                path = current_path.split("/")
-                current_path += "/"
-                text = os.path.basename(text)
-                for p in path:
-                    if type(current_options) is dict:
-                        if p in current_options:
-                            current_options = current_options[p]
-                        else:
-                            return None
-                    else:
-                        break
-            if type(current_options) is dict:
-                for k, v in current_options.items():
-                    value = ""
-                    if type(v) is dict:
-                        value = k + "/"
-                    elif type(k) is str:
-                        value = k
-                    if value and value.startswith(text):
-                        result.append(current_path + value)
-        else:  # no text entered, all matches possible
-            for k, v in self.files.items():
-                if type(v) is dict:
-                    result.append(k + "/")
-                elif type(k) is str:
-                    result.append(k)
-        return "\n".join(sorted(result))
+        return "\n".join(self.data.match(text))
+
+    def __page(self, dirname, offset, limit):
+        node = self.data.path_trie().lookup(dirname)
+        if node is None:
+            return "No such directory: {0}".format(dirname)
+        prefix = dirname.strip("/") + "/" if dirname.strip("/") else ""
+        names = self.data.listdir(dirname, offset, limit)
+        lines = [prefix + name for name in names]
+        lines.append("Entries {0}-{1} of {2}, {3} file(s), {4} bytes in {5}".format(
+            offset + 1 if names else offset, offset + len(names), len(node.names), node.count, node.size,
+            prefix or "/"))
+        return "\n".join(lines)
 
     def __download(self, url):
-        return get_url(url, "object ({0})".format(url), False, self.raw_cmd)
+        # raw even in the shell: a missing loose object is looked up in packs before anything is printed
+        return get_url(url, "object ({0})".format(url), False, True, self.options.get("session"))
 
     def __deflate(self, data):
         return zlib.decompress(data)
@@ -564,36 +2791,44 @@ class RunCommand(object):
             return data
 
 
-def build_nested_helper(path, text, container):
-    segs = path.split('/')
-    head = segs[0]
-    tail = segs[1:]
-    if not tail:
-        container[head] = 1
-    else:
-        if head not in container:
-            container[head] = {}
-        build_nested_helper('/'.join(tail), text, container[head])
+def normalize_url(url):
+    """(git folder url, index url) of a repository given with or without scheme and .git path."""
+    if urlparse(url).scheme not in ["http", "https"]:
+        url = "http://" + url
+    url = url.rstrip("/")
+    if urlparse(url).path == "":
+        return url + "/.git", url + "/.git/index"
+    return url, url + "/index"
 
 
-def build_nested(paths):
-    container = {}
-    for path in paths:
-        build_nested_helper(path, path, container)
-    return container
+def file_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
 
 
 class GitManager:
-    def __init__(self, url, force=False, raw_cmd=False, interactive=False, proxy_server=None):
+    def __init__(self, url, force=False, raw_cmd=False, interactive=False, proxy_server=None, dump=False, threads=4,
+                 pacing=None):
         self.interactive = True if interactive else False
         self.raw_cmd = True if raw_cmd else False
+        self.dump = True if dump else False
         self.message = ""
         self.data_dir = "data/"
         self.url = url
-        self.files = self.index_data = {}
+        self.index_data = None
+        self.index_stamp = None
+        # one command at a time when the manager is shared, e.g. by RepositoryCache
+        self.lock = threading.RLock()
         ensure_dir(self.data_dir)
-        if proxy_server:
-            set_proxy(proxy_server)
+        # keep-alive connections and the proxy belong to this manager
+        self.session = HttpSession(proxy_server)
+        self.profiler = self.session.profiler = Profiler()
+        # RequestPacer arguments: rate, burst, jitter, budget
+        if pacing:
+            self.session.pacer = RequestPacer(**pacing)
         if force:
             self.reload = True
         else:
@@ -602,16 +2837,10 @@ class GitManager:
         if urlparse(self.url).scheme not in ["http", "https"]:
             if self.raw_cmd is False:
                 print("Valid scheme not found in url. Using http instead.")
-            self.git_url = self.url = "http://" + self.url
+            self.url = "http://" + self.url
             if self.raw_cmd is False:
                 print("Working with {0} repository".format(self.url))
-        else:
-            self.git_url = self.url
-        if urlparse(self.url).path is "":
-            self.git_url += "/.git"
-            self.url += "/.git/index"
-        else:
-            self.url += "/index"
+        self.git_url, self.url = normalize_url(self.url)
         url_o = urlparse(self.url)
         if url_o.scheme == "https":
             self.dir_name = self.data_dir + "https_"+url_o.netloc.replace(":", "_")
@@ -622,49 +2851,48 @@ class GitManager:
         self.index_file = self.git_dir + "/index"
         self.index_parsed_file = self.index_file + ".parsed"
         self.index_json_file = self.index_file + ".json"
+        self.cache_file = self.index_file + ".cache"
+        self.meta_file = self.index_file + ".meta"
+        self.diff_file = self.index_file + ".diff"
         self.url_file = self.dir_name + "/url.git"
         self.options = {
             "dir_name": self.dir_name,
             "git_url": self.git_url,
             "git_obj_url": self.git_url + "/objects",
             "git_dir": self.git_dir,
-            "git_obj_dir": self.git_dir + "/objects"
+            "git_obj_dir": self.git_dir + "/objects",
+            "index_file": self.index_file,
+            "threads": threads,
+            "session": self.session,
+            "profiler": self.profiler
         }
-        if self.reload is True and self.interactive is False:
-            if query_yes_no("All objects index files will be removed. Are you sure want to force reload repo?", "no"):
-                self.clear_git()
-            else:
-                self.reload = False
+        # objects are shared by all repositories under data_dir
+        self.options["store"] = object_store(self.data_dir + ".objects")
+        self.packs = self.options["packs"] = PackStore(self.options["git_obj_url"], self.options["git_obj_dir"],
+                                                       self.session)
         if self.check_index():
             try:
                 self.download_index()
             except ValueError:
                 raise
-        if self.check_tree() or self.reload is True:
+        elif self.reload is True:
+            # forced reload only transfers and rebuilds an index that changed
+            self.refresh()
+        if self.dump is True:
             self.save_index()
-        self.pack_file = ''
         self.load_index()
 
-    def clear_git(self):
-        os.remove(self.tree_file)
-        os.remove(self.index_file)
-        os.remove(self.index_parsed_file)
-        os.remove(self.index_json_file)
-
     def check_index(self):
-        return not os.path.exists(self.index_file) or self.reload is True
-
-    def check_tree(self):
-        return not os.path.exists(self.tree_file)
+        return not os.path.exists(self.index_file)
 
     def download_index(self):
         self.show("Downloading index file ({0}) ...".format(self.url))
         if self.interactive is True:
-            r = get_url(self.url, "index", not self.interactive, self.raw_cmd)
+            r = get_url(self.url, "index", not self.interactive, self.raw_cmd, self.session)
             if r is False:
                 raise ValueError
         else:
-            r = get_url(self.url, "index", not self.raw_cmd, self.raw_cmd)
+            r = get_url(self.url, "index", not self.raw_cmd, self.raw_cmd, self.session)
         if r["error"] is 1:
             try:
                 self.show(r["response"], True)
@@ -672,13 +2900,111 @@ class GitManager:
                 raise
         else:
             r = r["response"]
+        with self.profiler.phase("index download"):
+            data = r.read()
+        self.write_index(r, data)
+
+    def write_index(self, response, data):
         ensure_dir(self.git_dir)
         with open(self.url_file, "w", encoding="utf-8") as uf:
             uf.write(self.git_url)
             uf.close()
         with open(self.index_file, "wb") as indexf:
-            indexf.write(r.read())
+            indexf.write(data)
             indexf.close()
+        # validators for the next conditional refresh
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        }
+        with open(self.meta_file, "w", encoding="utf-8") as mf:
+            mf.write(json.dumps(meta))
+            mf.close()
+
+    def probe_index(self):
+        """Compare the remote index header and trailer with the local index by Range requests.
+
+        Returns True only when both are known to be unchanged.
+        """
+        if not os.path.exists(self.index_file):
+            return False
+        with open(self.index_file, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+        for byte_range, local in (("bytes=0-11", header), ("bytes=-20", index_checksum(self.index_file))):
+            try:
+                resp = self.session.open(self.url, {"Range": byte_range})
+            except (urllib.error.URLError, ValueError):
+                return False
+            if resp.status != 206:
+                # the server ignores Range, do not download the whole file here
+                resp.close()
+                return False
+            if resp.read() != local:
+                return False
+        return True
+
+    def refresh(self):
+        """Fetch the index again only if it changed; return True when it was reloaded."""
+        if self.probe_index():
+            self.show("Index not modified.")
+            return False
+        headers = {}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, encoding="utf-8") as mf:
+                meta = json.load(mf)
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        self.show("Checking index file ({0}) ...".format(self.url))
+        r = get_url(self.url, "index", False, True, self.session, headers)
+        if r["error"] == 1:
+            self.show(r["response"])
+            return False
+        resp = r["response"]
+        with self.profiler.phase("index download"):
+            data = resp.read()
+        if resp.status == 304 or (os.path.exists(self.index_file) and data[-20:] == index_checksum(self.index_file)):
+            self.show("Index not modified.")
+            return False
+        old = self.index_data
+        if old is None and os.path.exists(self.index_file):
+            # forced reload before anything was loaded: the cache still maps the previous index
+            old = CompactIndex.load(self.cache_file, index_checksum(self.index_file))
+        self.write_index(resp, data)
+        # a changed index may come with a repack
+        self.packs.reset()
+        self.index_data = None
+        self.save_index()
+        self.load_index()
+        self.show("Index updated: {0} entries.".format(len(self.index_data)))
+        if old is not None:
+            self.apply_diff(old)
+        return True
+
+    def apply_diff(self, old):
+        """Carry the derived structures of the old index over to the new one and record the diff."""
+        added, removed, changed = diff_indexes(old, self.index_data)
+        # parsing and the cache save above read the whole index, the listings only follow the change
+        if old.trie is not None and self.index_data.trie is None:
+            with self.profiler.phase("path trie update"):
+                if old.trie.apply(old, self.index_data, added, removed, changed):
+                    self.index_data.trie = old.trie
+                old.trie = None
+        with search_indexes_lock:
+            search = search_indexes.pop(old.checksum, None)
+            if search is not None:
+                search.apply(added, removed)
+                search_indexes[self.index_data.checksum] = search
+        with open(self.diff_file, "w", encoding="utf-8") as df:
+            df.write(json.dumps({
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "added": added,
+                "removed": removed,
+                "changed": changed
+            }))
+            df.close()
+        self.show("Changes: {0} added, {1} removed, {2} changed.".format(len(added), len(removed), len(changed)))
 
     def show(self, message, error=False):
         if self.raw_cmd:
@@ -691,30 +3017,73 @@ class GitManager:
             print(message)
 
     def save_index(self):
-        index_parsed_data, self.index_data = gin_file(self.index_file)
+        with self.profiler.phase("index parse"):
+            self.index_data = CompactIndex.from_index(self.index_file)
+        with self.profiler.phase("cache save"):
+            self.index_data.save(self.cache_file)
+        if self.dump is True:
+            with self.profiler.phase("dumps"):
+                self.dump_index()
+
+    def dump_index(self):
         with open(self.index_parsed_file, "w", encoding="utf-8") as ipf:
-            ipf.write(index_parsed_data)
+            write_dump(self.index_file, ipf)
             ipf.close()
         with open(self.index_json_file, "w", encoding="utf-8") as ijf:
-            ijf.write(json.dumps(self.index_data, sort_keys=True, indent=2))
+            write_json_map(self.index_data, ijf)
             ijf.close()
-        self.files = build_nested(list(self.index_data.keys()))
         with open(self.tree_file, "w", encoding="utf-8") as tf:
-            tf.write(json.dumps(self.files))
+            tf.write(json.dumps(self.index_data.path_trie().nested()))
             tf.close()
 
     def load_index(self):
-        if not self.index_data:
-            self.index_data = json.load(open(self.index_json_file))
-        if not self.files:
-            self.files = json.load(open(self.tree_file))
+        # the cache is keyed by the index trailer checksum and rebuilt when it changes
+        if self.index_data is None:
+            with self.profiler.phase("cache load"):
+                self.index_data = CompactIndex.load(self.cache_file, index_checksum(self.index_file))
+        if self.index_data is None:
+            self.save_index()
+        with self.profiler.phase("tree read"):
+            self.index_data.tree = DirectoryIndex.from_tree(self.index_data, self.index_file)
+        self.index_stamp = file_stamp(self.index_file)
+
+    def profile(self):
+        """Timings and counters of this manager with the HTTP, store, pack and soft 404 totals."""
+        result = self.profiler.as_dict()
+        session = self.session
+        result["http"] = {"requests": session.requests, "connections": session.connections,
+                          "tls_handshakes": session.tls_handshakes, "reused": session.reused}
+        store = self.options["store"]
+        result["object_store"] = {"hits": store.hits, "misses": store.misses, "coalesced": store.coalesced}
+        packs = self.packs
+        result["packs"] = {"packs": len(packs.packs or []), "objects": packs.objects, "requests": packs.requests,
+                           "bytes": packs.received, "base_cache_hits": packs.hits}
+        result["soft_404"] = {"dropped": soft_not_found.dropped, "bytes_skipped": soft_not_found.skipped}
+        pacer = session.pacer
+        if pacer is not None:
+            result["pacing"] = {"requests": pacer.used, "budget": pacer.budget, "throttled": pacer.throttled,
+                                "waited": round(pacer.waited, 3), "interval": round(pacer.interval(), 6)}
+        return result
+
+    def nbytes(self):
+        """Approximate memory held by the loaded index, its path trie and its search index."""
+        if self.index_data is None:
+            return 0
+        size = self.index_data.nbytes()
+        if self.index_data.trie is not None:
+            size += self.index_data.trie.nbytes()
+        search = cached_search_index(self.index_data.checksum)
+        if search is not None:
+            size += search.nbytes()
+        return size
 
     def run(self):
-        completer = ListCompleter(self.files)
+        completer = ListCompleter(self.index_data)
         readline.set_completer_delims(" ")
         readline.set_completer(completer.complete)
         readline.parse_and_bind('tab: complete')
-        executor = RunCommand(self.index_data, self.files, self.options)
+        executor = RunCommand(self.index_data, self.options)
+        executor.manager = self
         while True:
             commands = input("{0} > ".format(self.git_url))
             if commands in ["exit", "quit", "q", "e"]:
@@ -724,29 +3093,302 @@ class GitManager:
                     sys.exit(0)
             command = commands.split(" ")
             if hasattr(executor, command[0]):
-                getattr(executor, command[0])(command[1:])
+                with self.profiler.phase("command " + command[0]):
+                    getattr(executor, command[0])(command[1:])
+                completer.options = self.index_data
             else:
                 print("Command '{0}' not found".format(command[0]))
 
-    def exec(self, cmd):
-        executor = RunCommand(self.index_data, self.files, self.options, self.raw_cmd)
-        command = cmd["cmd"]
-        if command == "exit" or command == "quit" or command == "q":
-            sys.exit(0)
-        if hasattr(executor, command):
-            self.show(getattr(executor, command)(cmd["args"]))
+    def exec(self, cmd, progress=None, cancel=None):
+        with self.lock:
+            executor = RunCommand(self.index_data, self.options, self.raw_cmd)
+            executor.manager = self
+            executor.progress = progress
+            executor.cancel = cancel
+            command = cmd["cmd"]
+            if command == "exit" or command == "quit" or command == "q":
+                sys.exit(0)
+            try:
+                if hasattr(executor, command):
+                    with self.profiler.phase("command " + command):
+                        output = getattr(executor, command)(cmd["args"])
+                    self.show(output)
+                else:
+                    self.show("Command '{0}' not found".format(command), True)
+            except ValueError:
+                self.message = ""
+                raise
+            # every call returns its own output only
+            message, self.message = self.message, ""
+            return message
+
+
+class RepositoryCache(object):
+    """Loaded GitManagers kept warm between commands, keyed by normalized git URL.
+
+    The least recently used repositories are dropped once the estimated memory
+    of the cached indexes exceeds limit. A repository whose index file was
+    changed on disk by someone else is loaded again.
+    """
+
+    def __init__(self, limit=256 * 1024 * 1024):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.managers = collections.OrderedDict()
+        # key: [Event, manager or exception] of a load in progress
+        self.flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidated = 0
+        self.evicted = 0
+
+    def get(self, url, factory):
+        """Cached manager of url, or the one factory(url) builds.
+
+        Concurrent calls for one url wait for a single factory() call, like
+        ObjectStore.get, and get its manager or its exception.
+        """
+        key = normalize_url(url)[0]
+        with self.lock:
+            manager = self.managers.get(key)
+            if manager is not None:
+                if manager.index_stamp == file_stamp(manager.index_file):
+                    self.managers.move_to_end(key)
+                    self.hits += 1
+                    return manager
+                self.__drop(key)
+                self.invalidated += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = [threading.Event(), None]
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.coalesced += 1
+        if not leader:
+            flight[0].wait()
+            if isinstance(flight[1], BaseException):
+                raise flight[1]
+            return flight[1]
+        try:
+            manager = factory(url)
+        except BaseException as e:
+            flight[1] = e
+            raise
         else:
-            self.show("Command '{0}' not found".format(command), True)
-        return self.message
+            flight[1] = manager
+            with self.lock:
+                self.managers[key] = manager
+                self.managers.move_to_end(key)
+                while len(self.managers) > 1 and self.nbytes() > self.limit:
+                    self.__drop(next(iter(self.managers)))
+                    self.evicted += 1
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight[0].set()
+        return manager
+
+    def nbytes(self):
+        return sum(m.nbytes() for m in self.managers.values())
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.managers):
+                self.__drop(key)
+
+    def report(self):
+        with self.lock:
+            return ("Repositories cached: {0} (~{1:.1f} MB), hits: {2}, misses: {3}, coalesced: {4}, "
+                    "invalidated: {5}, evicted: {6}".format(len(self.managers), self.nbytes() / 1048576.0, self.hits,
+                                                             self.misses, self.coalesced, self.invalidated,
+                                                             self.evicted))
+
+    def __drop(self, key):
+        manager = self.managers.pop(key)
+        if manager.index_data is not None:
+            with search_indexes_lock:
+                search_indexes.pop(manager.index_data.checksum, None)
+
+
+# where pwngit.py --serve listens and thin clients connect
+SOCKET_PATH = "data/pwngit.sock"
+
+
+class CommandServer(object):
+    """pwngit.py --serve: repositories kept loaded for thin clients on a Unix socket.
+
+    Clients send JSON lines {"url", "cmd", "args", "force", "progress"} and get
+    {"progress": [done, total, path]} lines while files are fetched (when asked
+    for), then one {"output": ...} or {"error": ...} line. Without url, "cache"
+    reports the loaded repositories and "shutdown" stops the server. A client
+    that goes away cancels its multi-file get.
+    """
+
+    def __init__(self, path=SOCKET_PATH, proxy_server=None, threads=4, pacing=None):
+        self.path = path
+        self.proxy_server = proxy_server
+        self.threads = threads
+        # every repository gets its own RequestPacer with these arguments
+        self.pacing = pacing
+        self.repositories = RepositoryCache()
+        self.server = None
+
+    def open_repository(self, url, force=False):
+        return GitManager(url, force, True, proxy_server=self.proxy_server, threads=self.threads, pacing=self.pacing)
+
+    def handle(self, request, send):
+        cmd = request.get("cmd", "")
+        url = request.get("url")
+        args = request.get("args", [])
+        if (not isinstance(cmd, str) or not isinstance(url, (str, type(None))) or not isinstance(args, list) or
+                not all(isinstance(a, str) for a in args)):
+            return {"error": "Invalid request: cmd and url must be strings, args a list of strings"}
+        if not url:
+            if cmd == "cache":
+                return {"output": self.repositories.report()}
+            if cmd == "shutdown":
+                threading.Thread(target=self.server.shutdown).start()
+                return {"output": "Server stopped."}
+            return {"error": "Repository url required"}
+        if cmd in ["exit", "quit", "q"]:
+            return {"output": ""}
+        force = bool(request.get("force"))
+        created = []
+        cancel = threading.Event()
+
+        def open_repository(url):
+            created.append(url)
+            return self.open_repository(url, force)
+
+        def progress(done, total, path):
+            try:
+                send({"progress": [done, total, path]})
+            except OSError:
+                cancel.set()
+
+        try:
+            manager = self.repositories.get(url, open_repository)
+            if force and not created:
+                with manager.lock:
+                    manager.refresh()
+            output = manager.exec({"cmd": cmd, "args": args},
+                                  progress if request.get("progress") else None, cancel)
+        except (ValueError, SystemExit) as e:
+            return {"error": str(e)}
+        return {"output": output}
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            try:
+                RemoteManager(None, self.path).close()
+                raise ValueError("Server is already running on {0}".format(self.path))
+            except OSError:
+                # left over by a server that did not stop cleanly
+                os.remove(self.path)
+        ensure_dir(os.path.dirname(self.path) or ".")
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, CommandHandler)
+        self.server.daemon_threads = True
+        self.server.commands = self
+        os.chmod(self.path, 0o600)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.path)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """One client connection of a CommandServer, any number of requests."""
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                reply = {"error": "Invalid request"}
+            else:
+                try:
+                    reply = self.server.commands.handle(request, self.send)
+                except Exception as e:
+                    # one bad request must not take the connection down without an answer
+                    print("Request {0!r} failed: {1!r}".format(request, e), file=sys.stderr)
+                    reply = {"error": "Command failed: {0}".format(e)}
+            try:
+                self.send(reply)
+            except OSError:
+                return
+
+
+class RemoteManager(object):
+    """GitManager stand-in running its commands in a pwngit.py --serve daemon.
+
+    Connecting raises OSError when no server listens on path.
+    """
+
+    def __init__(self, url, path=SOCKET_PATH, force=False):
+        self.url = url
+        self.force = force
+        self.message = ""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.reader = self.sock.makefile("rb")
+
+    def exec(self, cmd, progress=None, cancel=None):
+        request = {"url": self.url, "cmd": cmd["cmd"], "args": cmd["args"], "force": self.force,
+                   "progress": progress is not None or cancel is not None}
+        # only the first command reloads the index
+        self.force = False
+        self.sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        for line in self.reader:
+            reply = json.loads(line.decode("utf-8"))
+            if "progress" in reply:
+                if progress is not None:
+                    progress(*reply["progress"])
+                if cancel is not None and cancel.is_set():
+                    # the server stops the get once it cannot report to us anymore
+                    self.close()
+                    return "Cancelled."
+                continue
+            if "error" in reply:
+                raise ValueError(reply["error"])
+            return reply["output"]
+        raise ValueError("Server closed the connection")
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def connect_daemon(url, path=SOCKET_PATH, force=False):
+    """RemoteManager for url when a server is running on path, else None."""
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    try:
+        return RemoteManager(url, path, force)
+    except OSError:
+        return None
 
 
 class Interactive:
 
-    def __init__(self, proxy_server=None):
+    def __init__(self, proxy_server=None, pacing=None):
         self.data_dir = "data/"
         ensure_dir(self.data_dir)
-        if proxy_server:
-            set_proxy(proxy_server)
+        self.proxy_server = proxy_server
+        self.pacing = pacing
         self.cmd_list = ["ls", "help", "use"]
         while True:
             command = input("> ")
@@ -769,12 +3411,12 @@ class Interactive:
               "use <url>           run parser on url for working. ex.: use snoopdogg.com")
 
     def ls(self, args):
-        print("\n".join(next(os.walk(self.data_dir))[1]))
+        print("\n".join(d for d in next(os.walk(self.data_dir))[1] if not d.startswith(".")))
 
     def use(self, args):
         repo = "".join(args)
         try:
-            new = GitManager(repo, interactive=True)
+            new = GitManager(repo, interactive=True, proxy_server=self.proxy_server, pacing=self.pacing)
             new.run()
         except ValueError:
             pass
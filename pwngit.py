@@ -2,7 +2,9 @@
 # _*_ coding:utf-8 _*_
 import gitlib
 import argparse
+import json
 import sys
+import time
 
 
 def parse_cmd(cmd):
@@ -16,21 +18,87 @@ def parse_cmd(cmd):
     return command
 
 
+def write_profile(manager, filename):
+    # timings and counters of this run, '-' writes them to stderr
+    profile = json.dumps(manager.profile(), indent=2)
+    if filename == "-":
+        print(profile, file=sys.stderr)
+    else:
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(profile + "\n")
+
+
+def run_batch(manager, lines, load_time=0.0):
+    # one command per line against the loaded index, output printed as each one finishes
+    timings = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        c = parse_cmd(line)
+        if c["cmd"] in ["exit", "quit", "q"]:
+            break
+        start = time.time()
+        try:
+            output = manager.exec(c)
+        except ValueError as e:
+            output = str(e)
+        timings.append((time.time() - start, line))
+        print(output.rstrip(), flush=True)
+    total = sum(t for t, line in timings)
+    for t, line in timings:
+        print("{0:9.3f}s  {1}".format(t, line), file=sys.stderr)
+    print("Total: {0} command(s) in {1:.3f}s, index loaded in {2:.3f}s".format(len(timings), total, load_time),
+          file=sys.stderr)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("url", nargs='?', type=str, help="URL with path to git")
     parser.add_argument("-c", "--command", type=str, help="Raw command to execute")
+    parser.add_argument("-b", "--batch", type=str,
+                        help="Execute commands from file, one per line ('-' for stdin)")
     parser.add_argument("-f", "--force", type=bool, default=False, help="Force reload index file")
     parser.add_argument("-p", "--proxy", type=str, help="Proxy connection to git. ex.: http://127.0.0.1:8080")
+    parser.add_argument("-d", "--dump", action="store_true",
+                        help="Also write index.parsed, index.json and files.tree dumps")
+    parser.add_argument("-t", "--threads", type=int, default=4,
+                        help="Maximum concurrent object downloads per host (default: 4)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Requests per second to the target, 0 for no limit (default: 0)")
+    parser.add_argument("--burst", type=int, default=1, help="Requests allowed at once before --rate applies")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="Random extra delay, as a share of the request interval (ex.: 0.5)")
+    parser.add_argument("--budget", type=int, default=0,
+                        help="Maximum number of requests of this session, 0 for no limit (default: 0)")
+    parser.add_argument("--profile", type=str,
+                        help="Write phase timings and I/O counters of -c or -b as JSON to file ('-' for stderr)")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep repositories loaded and run commands sent to the socket")
+    parser.add_argument("--socket", type=str, default=gitlib.SOCKET_PATH,
+                        help="Unix socket of --serve, also used by -c and -b when a server runs "
+                             "(default: {0})".format(gitlib.SOCKET_PATH))
     arguments = parser.parse_args()
     if arguments.proxy:
         proxy = arguments.proxy
     else:
         proxy = None
-    if not arguments.url:
+    pacing = None
+    if arguments.rate or arguments.jitter or arguments.budget:
+        pacing = {"rate": arguments.rate, "burst": arguments.burst, "jitter": arguments.jitter,
+                  "budget": arguments.budget}
+    if arguments.serve:
+        print("Serving commands on {0} ...".format(arguments.socket))
+        try:
+            gitlib.CommandServer(arguments.socket, proxy, arguments.threads, pacing).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except ValueError as e:
+            print(e)
+    elif not arguments.url:
         cmd_list = ["list", "use", "help"]
         print("URL not specified. Run in interactive mode.")
-        gitlib.Interactive(proxy_server=proxy)
+        gitlib.Interactive(proxy_server=proxy, pacing=pacing)
     else:
         c = {}
         if arguments.url:
@@ -40,12 +108,38 @@ if __name__ == '__main__':
                 if c is False:
                     sys.exit(1)
             force = arguments.force
-            if c:
+            # a running server answers from its loaded index unless this run needs its own proxy, dumps, profile
+            # or pacing
+            remote = None
+            if (arguments.batch or c) and not proxy and not arguments.dump and not arguments.profile and not pacing:
+                remote = gitlib.connect_daemon(url, arguments.socket, force)
+            if arguments.batch:
+                try:
+                    start = time.time()
+                    new = remote or gitlib.GitManager(url, force, True, proxy_server=proxy, dump=arguments.dump,
+                                                      threads=arguments.threads, pacing=pacing)
+                    load_time = time.time() - start
+                    if new.message:
+                        print(new.message.rstrip(), flush=True)
+                        new.message = ""
+                    if arguments.batch == "-":
+                        run_batch(new, sys.stdin, load_time)
+                    else:
+                        with open(arguments.batch, encoding="utf-8") as batch:
+                            run_batch(new, batch, load_time)
+                    if arguments.profile:
+                        write_profile(new, arguments.profile)
+                except ValueError as e:
+                    print(e)
+            elif c:
                 try:
-                    new = gitlib.GitManager(url, force, True, proxy_server=proxy)
+                    new = remote or gitlib.GitManager(url, force, True, proxy_server=proxy, dump=arguments.dump,
+                                                      threads=arguments.threads, pacing=pacing)
                     print(new.exec(c).rstrip())
+                    if arguments.profile:
+                        write_profile(new, arguments.profile)
                 except ValueError as e:
                     print(e)
             else:
-                new = gitlib.GitManager(url, force)
+                new = gitlib.GitManager(url, force, dump=arguments.dump, threads=arguments.threads, pacing=pacing)
                 new.run()
@@ -3,7 +3,13 @@
 import gitlib
 import logging
 from telegram import Updater
+import collections
+import concurrent.futures
+import gzip
+import io
 import sys
+import threading
+import time
 
 token = "[TOKEN_HERE]"
 # Enable logging
@@ -12,6 +18,66 @@ logging.basicConfig(
         level=logging.INFO)
 
 logger = logging.getLogger(__name__)
+# loaded repositories stay in memory between messages
+repositories = gitlib.RepositoryCache()
+# longer output is sent as a gzipped document
+MESSAGE_LIMIT = 4096
+# seconds between two progress messages of one job
+PROGRESS_INTERVAL = 5
+# socket of a pwngit.py --serve daemon to send commands to, None loads repositories here
+SOCKET = None
+# request pacing of every repository, ex.: {"rate": 2, "jitter": 0.5, "budget": 500}; None sends at full speed
+PACING = None
+
+
+class JobQueue(object):
+    """Bot commands run by a bounded pool of workers instead of the dispatcher.
+
+    A chat may have per_chat jobs queued or running at once. Every job gets a
+    threading.Event that cancel() sets; a running get stops between files.
+    """
+
+    def __init__(self, workers=4, per_chat=2):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.per_chat = per_chat
+        self.lock = threading.Lock()
+        self.jobs = collections.defaultdict(list)
+
+    def submit(self, chat_id, target, *args):
+        """Run target(cancel, *args); return the number of jobs ahead, or None if the chat is at its limit."""
+        with self.lock:
+            jobs = self.jobs[chat_id]
+            if len(jobs) >= self.per_chat:
+                return None
+            ahead = max(0, sum(len(j) for j in self.jobs.values()) - self.workers + 1)
+            cancel = threading.Event()
+            job = [None, cancel]
+            jobs.append(job)
+            job[0] = self.pool.submit(target, cancel, *args)
+        job[0].add_done_callback(lambda future: self.__done(chat_id, job))
+        return ahead
+
+    def cancel(self, chat_id):
+        with self.lock:
+            jobs = list(self.jobs.get(chat_id, []))
+        for future, cancel in jobs:
+            cancel.set()
+            future.cancel()
+        return len(jobs)
+
+    def __done(self, chat_id, job):
+        with self.lock:
+            jobs = self.jobs.get(chat_id, [])
+            for n, (future, cancel) in enumerate(jobs):
+                if future is job[0]:
+                    del jobs[n]
+                    break
+            if not jobs:
+                self.jobs.pop(chat_id, None)
+
+
+jobs = JobQueue()
 
 
 def shutdown(bot, update):
@@ -23,20 +89,66 @@ def start(bot, update):
     bot.sendMessage(chat_id=update.message.chat_id, text="Hello, master!")
 
 
-def git(bot, update, args):
-    """
-        if message_length >= 4096:
-            i = 0
-        while i < message_length:
-            bot.sendMessage(
-                chat_id,
-                text="```\n{0}```".format(output[i:i+4095]),
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
-            i += 4095
+def cache(bot, update):
+    bot.sendMessage(chat_id=update.message.chat_id, text=repositories.report())
+
+
+def cancel(bot, update):
+    count = jobs.cancel(update.message.chat_id)
+    bot.sendMessage(chat_id=update.message.chat_id, text="Cancelled {0} job(s).".format(count))
+
+
+def open_repository(url):
+    return gitlib.GitManager(url, False, True, pacing=PACING)
+
+
+def reply(bot, chat_id, name, output):
+    if len(output) + 8 >= MESSAGE_LIMIT:
+        document = io.BytesIO(gzip.compress(output.encode("utf-8")))
+        bot.sendDocument(chat_id, document=document, filename="{0}.txt.gz".format(name))
+    else:
+        bot.sendMessage(
+            chat_id,
+            text="```\n{0}```".format(output),
+            parse_mode="Markdown",
+            disable_web_page_preview=True
+        )
+
+
+def run_git(cancelled, bot, chat_id, url, cmd, params):
+    last = [time.time()]
+
+    def progress(done, total, path):
+        if time.time() - last[0] >= PROGRESS_INTERVAL:
+            last[0] = time.time()
+            bot.sendMessage(chat_id, text="{0}: {1}/{2} file(s)".format(cmd, done, total))
+
+    if cancelled.is_set():
+        return
+    remote = gitlib.connect_daemon(url, SOCKET) if SOCKET else None
+    try:
+        new = remote or repositories.get(url, open_repository)
+        output = new.exec({"cmd": cmd, "args": params}, progress, cancelled)
+    except ValueError as e:
+        output = str(e)
+    except Exception as e:
+        logger.exception("Command %s on %s failed", cmd, url)
+        output = "Command failed: {0}".format(e)
+    except SystemExit:
+        # gitlib exits on an unreadable index and on exit; here that only ends this job
+        logger.exception("Command %s on %s exited", cmd, url)
+        if cmd in ("exit", "quit", "q"):
+            output = "Command {0} is not available in the bot.".format(cmd)
         else:
-    """
+            output = "Command failed: cannot read the index of {0}".format(url)
+    finally:
+        if remote is not None:
+            remote.close()
+    reply(bot, chat_id, cmd, output)
+
+
+def git(bot, update, args):
+    """Queue the command; its output comes back when a worker is done with it."""
     chat_id = update.message.chat_id
     if len(args) < 2:
         bot.sendMessage(chat_id, text="Usage: /git <url> <command> [params]\n"
@@ -44,31 +156,17 @@ def git(bot, update, args):
                                       "ls [dir] — directory listing (try it for first)\n"
                                       "find <query> — search in filenames can use wildcard * (ex.: find *.tgz)\n"
                                       "search <query> — search in all path, working as LIKE in T-SQL\n"
-                                      "get <path> — get file content\n")
+                                      "get <path> — get file content\n"
+                                      "/cancel stops your running and queued commands\n")
     else:
         url = args[0]
         cmd = args[1]
         params = args[2:]
-        try:
-            new = gitlib.GitManager(url, False, True)
-            output = new.exec({"cmd": cmd, "args": params})
-        except ValueError as e:
-            output = e
-        message_length = len(output)
-        if message_length >= 4096:
-            bot.sendMessage(
-                chat_id,
-                text="```\n{0}```".format(output[0:4092]+"..."),
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
-        else:
-            bot.sendMessage(
-                chat_id,
-                text="```\n{0}```".format(output[0:message_length]),
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
+        ahead = jobs.submit(chat_id, run_git, bot, chat_id, url, cmd, params)
+        if ahead is None:
+            bot.sendMessage(chat_id, text="Too many commands running, wait for them or /cancel.")
+        elif ahead:
+            bot.sendMessage(chat_id, text="Queued, {0} job(s) ahead.".format(ahead))
 
 if __name__ == '__main__':
     updater = Updater(token=token)
@@ -76,5 +174,7 @@ if __name__ == '__main__':
     dispatcher.addTelegramCommandHandler('shutdown', shutdown)
     dispatcher.addTelegramCommandHandler('start', start)
     dispatcher.addTelegramCommandHandler('git', git)
+    dispatcher.addTelegramCommandHandler('cache', cache)
+    dispatcher.addTelegramCommandHandler('cancel', cancel)
     updater.start_polling()
     sys.exit(0)